@@ -1,7 +1,10 @@
-import matplotlib.pyplot as plt
-from process.io.mfile import MFile
+from matplotlib import colormaps
+from matplotlib.figure import Figure
+from stellarator_analysis.scripts.mfile_reader import reader_stats
+from stellarator_analysis.scripts import constraint_map, plot_graph, results_query, results_store
 import numpy as np
 import os
+import time
 from dataclasses import dataclass, field
 
 
@@ -15,13 +18,22 @@ class Settings:
     var_label = 'Coil aspect'
     workdir = os.path.dirname(os.path.realpath(__file__))
     exclusion_list = []
+    active_tol = 1e-3
     
 
-def main(main_name=Settings.main_name):
+CONSTRAINT_NAMES = {
+    '024': 'Beta', '008': 'Neutron_wall_load', '017': 'Radiation_fraction', '018': 'Divertor_heat_load',
+    '067': 'Radiation Wall load', '082': 'toroidalgap', '083': 'radialspace', '062': 'f_alpha_confinement',
+    '032': 'TF_coil_stress', '034': 'Dump voltage', '035': 'J_WP / J_p', '065': 'VV stress'
+}
+
+
+def main(main_name=Settings.main_name, max_workers=None):
     """
     Collect and plot output from MFILE.DAT in main_name directory
     prefix is a name of the MFILE.DAT file
     param is PROCESS parameter name loaded form the input
+    Figures of all cases are rendered in parallel on max_workers processes
     """
     case_dir = Settings.workdir
     caselist = [case for case in os.listdir(case_dir) 
@@ -29,35 +41,46 @@ def main(main_name=Settings.main_name):
                     and case not in Settings.exclusion_list)]
     print(caselist)
 
+    start = time.perf_counter()
+    graphs = {}
+    jobs = []
     for case in caselist:
         print(f'Processing case: {case}')
         subdir = os.path.join(Settings.workdir, case, main_name)
+        graph = plot_graph.PlotGraph(os.path.join(Settings.workdir, case, 'plot_state.json'),
+                                     prefix=Settings.prefix)
+        graphs[case] = graph
+        results_store.load(subdir, Settings.prefix, verbose=True)
+
+        jobs.append((graph, plot_coe_capcost, (subdir,), {}))
+        jobs.append((graph, plot_parameters, (subdir,), {}))
+        jobs.append((graph, plot_parameters2, (subdir,), {}))
+        jobs.append((graph, plot_constrains, (subdir,), {}))
+        jobs.append((graph, plot_power, (subdir,), {}))
 
-        plot_coe_capcost(subdir)
-        plot_parameters(subdir)
-        plot_parameters2(subdir)
-        plot_constrains(subdir)
-        plot_power(subdir)
+    plot_graph.render_all(jobs, max_workers)
+    for case, graph in graphs.items():
+        graph.save()
+        print(f'{case}: ', end='')
+        graph.report()
+    print(f'{len(caselist)} cases plotted in {time.perf_counter() - start:.2f} s')
+
+    reader_stats.report()
+    results_store.cache_report()
 
 
 def load_results(workdir, var_name, results_name, verbose=False):
     """
-    Load results from MFILE.DAT files in the specified directory.
+    Load results of converged cases from the columnar results store of the specified directory.
     """
-    case_name = []
-    results = []
-    output = {}
-
-    for case in os.listdir(workdir):   
-        mfile_path = os.path.join(workdir, case, Settings.prefix+'.MFILE.DAT')
-        if os.path.isfile(mfile_path):
-            m = MFile(filename=mfile_path)
-            if m.data[results_name].get_number_of_scans() == 1 and m.data['ifail'].get_scan(-1) == 1:
-                case_name.append(m.data[var_name].get_scan(-1))
-                results.append(m.data[results_name].get_scan(-1))
-                output[m.data[var_name].get_scan(-1)] = m.data[results_name].get_scan(-1)
-
-    output = dict(sorted(output.items()))
+    plot_graph.track(workdir, var_name)
+    plot_graph.track(workdir, results_name)
+    selection = results_query.open_scan(workdir, Settings.prefix).select(var_name, results_name).converged().arrays()
+    x = selection[var_name]
+    y = selection[results_name]
+    finite = np.isfinite(x) & np.isfinite(y)
+
+    output = dict(sorted(zip(x[finite].tolist(), y[finite].tolist())))
     if verbose:
         print(f'{results_name} found for {var_name}:')
         for key, value in output.items():
@@ -66,6 +89,15 @@ def load_results(workdir, var_name, results_name, verbose=False):
     return output
 
 
+def save_figure(fig, path):
+    """
+    Save fig, record it as an output of the figure being rendered and release it.
+    """
+    fig.savefig(path)
+    plot_graph.saved(path)
+    fig.clear()
+
+
 def plot_coe_capcost(workdir, var_name=Settings.var_name):
     """
     Plot COE and capital cost against the variable name on the same plot with two y-axes.
@@ -75,7 +107,8 @@ def plot_coe_capcost(workdir, var_name=Settings.var_name):
     capcost = load_results(workdir, var_name, 'capcost', verbose=True)
 
 
-    fig1, ax1 = plt.subplots(figsize=(7, 5))
+    fig1 = Figure(figsize=(7, 5))
+    ax1 = fig1.subplots()
 
     x = list(coe.keys())
     y1 = list(coe.values())
@@ -97,11 +130,10 @@ def plot_coe_capcost(workdir, var_name=Settings.var_name):
     ax2.tick_params(axis='y', labelcolor=color2)
     ax2.set_ylim(bottom=0, top=max(y2)*1.1)  # Set y-axis from 0 to 110% of max
 
-    plt.title('Cost of Electricity and Capital Cost vs Power')
+    ax1.set_title('Cost of Electricity and Capital Cost vs Power')
     fig1.tight_layout()
     # plt.show()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'coe_capcost_plot.png'))
-    plt.close()
+    save_figure(fig1, os.path.join(os.path.dirname(workdir), 'coe_capcost_plot.png'))
 
 
 def plot_parameters(workdir, var_name=Settings.var_name):
@@ -113,7 +145,8 @@ def plot_parameters(workdir, var_name=Settings.var_name):
     rmajor = load_results(workdir, var_name, 'rmajor')
     aspect = load_results(workdir, var_name, 'coil_aspect')
 
-    fig2, ax1 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax1 = fig2.subplots()
     x = list(bt.keys())
     y1 = list(bt.values())
     y2 = list(rmajor.values())
@@ -141,10 +174,9 @@ def plot_parameters(workdir, var_name=Settings.var_name):
     ax3.tick_params(axis='y', labelcolor=color3)
     ax3.set_ylim(bottom=min(y3)*0.9, top=max(y3)*1.1)
 
-    plt.title('Bt, Rmajor and Coil scaling vs Power')
+    ax1.set_title('Bt, Rmajor and Coil scaling vs Power')
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'parameters_plot.png'))
-    plt.close()
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'parameters_plot.png'))
 
 
 def plot_parameters2(workdir, var_name=Settings.var_name):
@@ -156,7 +188,8 @@ def plot_parameters2(workdir, var_name=Settings.var_name):
     dene = load_results(workdir, var_name, 'nd_plasma_electrons_vol_avg')
     hfact = load_results(workdir, var_name, 'hfact')
 
-    fig2, ax1 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax1 = fig2.subplots()
     x = list(te.keys())
     y1 = list(te.values())
     y2 = list(dene.values())
@@ -184,10 +217,9 @@ def plot_parameters2(workdir, var_name=Settings.var_name):
     ax3.tick_params(axis='y', labelcolor=color3)
     ax3.set_ylim(bottom=min(y3)*0.9, top=max(y3)*1.1)
 
-    plt.title('Te, ne and H-fact vs Power')
+    ax1.set_title('Te, ne and H-fact vs Power')
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'parameters2_plot.png'))
-    plt.close()
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'parameters2_plot.png'))
     
 
 @dataclass
@@ -204,28 +236,31 @@ def plot_constrains(workdir, var_name=Settings.var_name):
     Plot constrains normalized residues against power.
     """
 
-    constrains_id = ['024', '008', '017', '018', '067', '082', '083', '062', '032', '034', '035', '065']
-    constrains_names = [
-        'Beta', 'Neutron_wall_load', 'Radiation_fraction', 'Divertor_heat_load', 'Radiation Wall load', 'toroidalgap', 'radialspace',
-        'f_alpha_confinement', 'TF_coil_stress', 'Dump voltage', 'J_WP / J_p', 'VV stress'
-    ]
-    list_of_constrains = []
+    table = results_store.load(workdir, Settings.prefix)
+    plot_graph.track(workdir, var_name)
+    for name in table.names:
+        if name.startswith('ineq_con'):
+            plot_graph.track(workdir, name)
+    active_map = constraint_map.build(table, var_name, Settings.active_tol)
 
-    for idx, name in zip(constrains_id, constrains_names):
+    list_of_constrains = []
+    for j, idx in enumerate(active_map.constraints):
+        finite = np.isfinite(active_map.residuals[:, j])
         list_of_constrains.append(Constrain(
             number=idx,
-            name=name,
-            results=load_results(workdir, var_name, 'ineq_con' + idx)
+            name=CONSTRAINT_NAMES.get(idx, 'ineq_con' + idx),
+            results=dict(zip(active_map.scan_value[finite].tolist(), active_map.residuals[finite, j].tolist()))
         ))
 
-    fig, ax1 = plt.subplots(figsize=(10, 7))  # Increased figsize for legend
+    fig = Figure(figsize=(10, 7))  # Increased figsize for legend
+    ax1 = fig.subplots()
 
     ax1.set_xlabel(Settings.var_label)
     ax1.set_ylabel('normalised residue')
     ax1.set_ylim(bottom=0, top=1)
 
     # Use a colormap to assign a unique color to each line
-    cmap = plt.get_cmap('tab20')
+    cmap = colormaps['tab20']
     num_lines = len(list_of_constrains)
     colors = [cmap(i % 20) for i in range(num_lines)]
 
@@ -239,11 +274,14 @@ def plot_constrains(workdir, var_name=Settings.var_name):
             color=colors[i]
         )
 
-    plt.title('Constrains')
+    # Mark where the set of active constraints changes
+    for boundary in active_map.boundaries():
+        ax1.axvline(boundary.value, color='grey', linestyle=':', linewidth=1)
+
+    ax1.set_title('Constrains')
     ax1.legend(loc='center left', bbox_to_anchor=(1.02, 0.5), borderaxespad=0)
     fig.tight_layout(rect=[0, 0, 0.82, 1])  # Leave space for legend
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'constrains_plot.png'))
-    plt.close()
+    save_figure(fig, os.path.join(os.path.dirname(workdir), 'constrains_plot.png'))
 
 
 def plot_power(workdir, var_name=Settings.var_name):
@@ -253,7 +291,8 @@ def plot_power(workdir, var_name=Settings.var_name):
     P_rec = load_results(workdir, var_name, 'p_plant_electric_recirc_mw')
     P_fus = load_results(workdir, var_name, 'p_fusion_total_mw')
 
-    fig, ax1 = plt.subplots(figsize=(7, 5))  # Increased figsize for legend
+    fig = Figure(figsize=(7, 5))  # Increased figsize for legend
+    ax1 = fig.subplots()
 
     ax1.set_xlabel(Settings.var_label)
     ax1.set_ylabel('Power (MW)')
@@ -264,10 +303,10 @@ def plot_power(workdir, var_name=Settings.var_name):
     ax1.plot(P_net.keys(), P_rec.values(), marker='o', linestyle='-', label='P_rec')
     ax1.plot(P_net.keys(), P_fus.values(), marker='o', linestyle='-', label='P_fus')
 
-    plt.title('Power')
+    ax1.set_title('Power')
     ax1.legend()
     fig.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'power_plot.png'))
+    save_figure(fig, os.path.join(os.path.dirname(workdir), 'power_plot.png'))
 
 
 
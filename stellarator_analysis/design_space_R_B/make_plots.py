@@ -1,7 +1,10 @@
-import matplotlib.pyplot as plt
-from process.io.mfile import MFile
+from matplotlib import colormaps
+from matplotlib.figure import Figure
+from stellarator_analysis.scripts.mfile_reader import reader_stats
+from stellarator_analysis.scripts import constraint_map, plot_graph, results_query, results_store
 import numpy as np
 import os
+import time
 from dataclasses import dataclass, field
 
 
@@ -15,13 +18,26 @@ class Settings:
     var_label = 'B (T)'
     workdir = os.path.dirname(os.path.realpath(__file__))
     exclusion_list = ['HTS_high_stress']
+    active_tol = 1e-3
     
 
-def main(main_name=Settings.main_name):
+# Labels and colours of the constraint regimes of the B scan, see constraint_map
+REGIME_LABELS = {'lower': 'Low field', 'transition': 'Optimal field', 'upper': 'High field'}
+REGIME_COLORS = {'lower': 'red', 'transition': 'green', 'upper': 'orange', 'uniform': 'grey'}
+
+CONSTRAINT_NAMES = {
+    '024': 'Beta', '008': 'Neutron_wall_load', '017': 'Radiation_fraction', '018': 'Divertor_heat_load',
+    '067': 'Radiation Wall load', '082': 'toroidalgap', '083': 'radialspace', '062': 'f_alpha_confinement',
+    '032': 'TF_coil_stress', '034': 'Dump voltage', '035': 'J_WP / J_p', '065': 'VV stress'
+}
+
+
+def main(main_name=Settings.main_name, max_workers=None):
     """
     Collect and plot output from MFILE.DAT in main_name directory
     prefix is a name of the MFILE.DAT file
     param is PROCESS parameter name loaded form the input
+    Figures of all cases are rendered in parallel on max_workers processes
     """
     case_dir = Settings.workdir
     caselist = [case for case in os.listdir(case_dir) 
@@ -29,38 +45,49 @@ def main(main_name=Settings.main_name):
                     and case not in Settings.exclusion_list)]
     print(caselist)
 
+    start = time.perf_counter()
+    graphs = {}
+    jobs = []
     for case in caselist:
         print(f'Processing case: {case}')
         subdir = os.path.join(Settings.workdir, case, main_name)
+        graph = plot_graph.PlotGraph(os.path.join(Settings.workdir, case, 'plot_state.json'),
+                                     prefix=Settings.prefix)
+        graphs[case] = graph
+        results_store.load(subdir, Settings.prefix, verbose=True)
 
         # plot_coe_capcost(subdir)
         # plot_parameters(subdir)
-        plot_parameters2(subdir)
-        plot_parameters3(subdir)
+        jobs.append((graph, plot_parameters2, (subdir,), {}))
+        jobs.append((graph, plot_parameters3, (subdir,), {}))
         # # plot_constrains(subdir)
-        plot_constrains(subdir, selected_constrains=['024', '008', '083', '062', '032'])
-        plot_R_major(subdir)
+        jobs.append((graph, plot_constrains, (subdir,), {'selected_constrains': ['024', '008', '083', '062', '032']}))
+        jobs.append((graph, plot_R_major, (subdir,), {}))
         # plot_power(subdir)
 
+    plot_graph.render_all(jobs, max_workers)
+    for case, graph in graphs.items():
+        graph.save()
+        print(f'{case}: ', end='')
+        graph.report()
+    print(f'{len(caselist)} cases plotted in {time.perf_counter() - start:.2f} s')
+
+    reader_stats.report()
+    results_store.cache_report()
+
 
 def load_results(workdir, var_name, results_name, verbose=False):
     """
-    Load results from MFILE.DAT files in the specified directory.
+    Load results of converged cases from the columnar results store of the specified directory.
     """
-    case_name = []
-    results = []
-    output = {}
-
-    for case in os.listdir(workdir):   
-        mfile_path = os.path.join(workdir, case, Settings.prefix+'.MFILE.DAT')
-        if os.path.isfile(mfile_path):
-            m = MFile(filename=mfile_path)
-            if m.data[results_name].get_number_of_scans() == 1 and m.data['ifail'].get_scan(-1) == 1:
-                case_name.append(m.data[var_name].get_scan(-1))
-                results.append(m.data[results_name].get_scan(-1))
-                output[m.data[var_name].get_scan(-1)] = m.data[results_name].get_scan(-1)
-
-    output = dict(sorted(output.items()))
+    plot_graph.track(workdir, var_name)
+    plot_graph.track(workdir, results_name)
+    selection = results_query.open_scan(workdir, Settings.prefix).select(var_name, results_name).converged().arrays()
+    x = selection[var_name]
+    y = selection[results_name]
+    finite = np.isfinite(x) & np.isfinite(y)
+
+    output = dict(sorted(zip(x[finite].tolist(), y[finite].tolist())))
     if verbose:
         print(f'{results_name} found for {var_name}:')
         for key, value in output.items():
@@ -69,6 +96,15 @@ def load_results(workdir, var_name, results_name, verbose=False):
     return output
 
 
+def save_figure(fig, path):
+    """
+    Save fig, record it as an output of the figure being rendered and release it.
+    """
+    fig.savefig(path)
+    plot_graph.saved(path)
+    fig.clear()
+
+
 def plot_coe_capcost(workdir, var_name=Settings.var_name):
     """
     Plot COE and capital cost against the variable name on the same plot with two y-axes.
@@ -78,7 +114,8 @@ def plot_coe_capcost(workdir, var_name=Settings.var_name):
     capcost = load_results(workdir, var_name, 'capcost', verbose=True)
 
 
-    fig1, ax1 = plt.subplots(figsize=(7, 5))
+    fig1 = Figure(figsize=(7, 5))
+    ax1 = fig1.subplots()
 
     x = list(coe.keys())
     y1 = list(coe.values())
@@ -100,10 +137,10 @@ def plot_coe_capcost(workdir, var_name=Settings.var_name):
     ax2.tick_params(axis='y', labelcolor=color2)
     ax2.set_ylim(bottom=0, top=max(y2)*1.1)  # Set y-axis from 0 to 110% of max
 
-    plt.title('Cost of Electricity and Capital Cost vs Power')
+    ax1.set_title('Cost of Electricity and Capital Cost vs Power')
     fig1.tight_layout()
     # plt.show()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'coe_capcost_plot.png'))
+    save_figure(fig1, os.path.join(os.path.dirname(workdir), 'coe_capcost_plot.png'))
 
 
 def plot_parameters(workdir, var_name=Settings.var_name):
@@ -115,7 +152,8 @@ def plot_parameters(workdir, var_name=Settings.var_name):
     rmajor = load_results(workdir, var_name, 'rmajor')
     aspect = load_results(workdir, var_name, 'coil_aspect')
 
-    fig2, ax1 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax1 = fig2.subplots()
     x = list(bt.keys())
     y1 = list(bt.values())
     y2 = list(rmajor.values())
@@ -145,7 +183,7 @@ def plot_parameters(workdir, var_name=Settings.var_name):
 
     # plt.title('Bt, Rmajor and Coil scaling vs Power')
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'parameters_plot.png'))
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'parameters_plot.png'))
 
 
 def plot_parameters2(workdir, var_name=Settings.var_name):
@@ -157,16 +195,14 @@ def plot_parameters2(workdir, var_name=Settings.var_name):
     dene = load_results(workdir, var_name, 'nd_plasma_electrons_vol_avg')
     hfact = load_results(workdir, var_name, 'hfact')
 
-    fig2, ax1 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax1 = fig2.subplots()
     x = list(te.keys())
     y1 = list(te.values())
     y2 = list(dene.values())
     y3 = list(hfact.values())
 
-    set_boxes(ax1, labels=False)
-    ax1.text(5.8, 8.8, 'Low field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-    ax1.text(6.35, 8.8, 'Optimal field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-    ax1.text(6.9, 8.8, 'High field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
+    set_boxes(ax1, workdir, var_name)
 
     color1 = 'tab:blue'
     ax1.set_xlabel(Settings.var_label)
@@ -192,7 +228,7 @@ def plot_parameters2(workdir, var_name=Settings.var_name):
 
     # plt.title('Te, ne and H-fact vs Power')
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'parameters2_plot.png'))
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'parameters2_plot.png'))
     
 
 def plot_parameters3(workdir, var_name=Settings.var_name):
@@ -205,14 +241,15 @@ def plot_parameters3(workdir, var_name=Settings.var_name):
     hfact = load_results(workdir, var_name, 'hfact')
     rmajor = load_results(workdir, var_name, 'rmajor')
 
-    fig2, ax0 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax0 = fig2.subplots()
     x = list(te.keys())
     y0 = list(rmajor.values())
     y1 = list(te.values())
     y2 = list(dene.values())
     y3 = list(hfact.values())
 
-    set_boxes(ax0, labels=True)
+    set_boxes(ax0, workdir, var_name)
 
     ax0.set_xlabel(Settings.var_label)
     color2 = 'k'
@@ -248,7 +285,7 @@ def plot_parameters3(workdir, var_name=Settings.var_name):
 
     # plt.title('Te, ne and H-fact vs Power')
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'parameters3_plot.png'))
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'parameters3_plot.png'))
 
 @dataclass
 class Constrain:
@@ -259,22 +296,33 @@ class Constrain:
     name: str
     results: dict = field(default_factory= lambda: { })
 
+def load_constraint_map(workdir, var_name=Settings.var_name, active_tol=Settings.active_tol):
+    """
+    Active-constraint map of the converged cases over var_name, built from all ineq_con### columns.
+    """
+    table = results_store.load(workdir, Settings.prefix)
+    plot_graph.track(workdir, var_name)
+    for name in table.names:
+        if name.startswith('ineq_con'):
+            plot_graph.track(workdir, name)
+    return constraint_map.build(table, var_name, active_tol)
+
+
 def load_constrains_data(workdir, var_name, selected_constrains=None):
-    constrains_id = ['024', '008', '017', '018', '067', '082', '083', '062', '032', '034', '035', '065']
-    constrains_names = [
-        'Beta', 'Neutron_wall_load', 'Radiation_fraction', 'Divertor_heat_load', 'Radiation Wall load', 'toroidalgap', 'radialspace',
-        'f_alpha_confinement', 'TF_coil_stress', 'Dump voltage', 'J_WP / J_p', 'VV stress'
-    ]
+    """
+    Residuals of the selected constraints, by default of every ineq_con### column of the scan.
+    """
+    active_map = load_constraint_map(workdir, var_name)
     list_of_constrains = []
-
-    for idx, name in zip(constrains_id, constrains_names):
+    for j, idx in enumerate(active_map.constraints):
         if selected_constrains is None or idx in selected_constrains:
+            finite = np.isfinite(active_map.residuals[:, j])
             list_of_constrains.append(Constrain(
                 number=idx,
-                name=name,
-                results=load_results(workdir, var_name, 'ineq_con' + idx)
+                name=CONSTRAINT_NAMES.get(idx, 'ineq_con' + idx),
+                results=dict(zip(active_map.scan_value[finite].tolist(), active_map.residuals[finite, j].tolist()))
             ))
-        
+
     return list_of_constrains
 
 
@@ -285,19 +333,17 @@ def plot_constrains(workdir, var_name=Settings.var_name, selected_constrains=Non
 
     list_of_constrains = load_constrains_data(workdir, var_name, selected_constrains)
 
-    fig, ax1 = plt.subplots(figsize=(10, 7))  # Increased figsize for legend
+    fig = Figure(figsize=(10, 7))  # Increased figsize for legend
+    ax1 = fig.subplots()
 
-    set_boxes(ax1, labels=False)
-    ax1.text(5.8, 0.9, 'Low field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-    ax1.text(6.35, 0.9, 'Optimal field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-    ax1.text(6.9, 0.9, 'High field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
+    set_boxes(ax1, workdir, var_name)
 
     ax1.set_xlabel(Settings.var_label)
     ax1.set_ylabel('normalised residue')
     ax1.set_ylim(bottom=0, top=1)
 
     # Use a colormap to assign a unique color to each line
-    cmap = plt.get_cmap('tab20')
+    cmap = colormaps['tab20']
     num_lines = len(list_of_constrains)
     colors = [cmap(i % 20) for i in range(num_lines)]
 
@@ -312,11 +358,11 @@ def plot_constrains(workdir, var_name=Settings.var_name, selected_constrains=Non
                 color=colors[i]
             )
 
-    plt.title('Constrains')
+    ax1.set_title('Constrains')
     # ax1.legend(loc='center left', bbox_to_anchor=(1.02, 0.5), borderaxespad=0)
     ax1.legend(loc='upper right')
     fig.tight_layout(rect=[0, 0, 0.82, 1])  # Leave space for legend
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'constrains_plot.png'))
+    save_figure(fig, os.path.join(os.path.dirname(workdir), 'constrains_plot.png'))
 
 
 
@@ -327,7 +373,8 @@ def plot_power(workdir, var_name=Settings.var_name):
     P_rec = load_results(workdir, var_name, 'p_plant_electric_recirc_mw')
     P_fus = load_results(workdir, var_name, 'p_fusion_total_mw')
 
-    fig, ax1 = plt.subplots(figsize=(7, 5))  # Increased figsize for legend
+    fig = Figure(figsize=(7, 5))  # Increased figsize for legend
+    ax1 = fig.subplots()
 
     ax1.set_xlabel(Settings.var_label)
     ax1.set_ylabel('Power (MW)')
@@ -338,10 +385,10 @@ def plot_power(workdir, var_name=Settings.var_name):
     ax1.plot(P_net.keys(), P_rec.values(), marker='o', linestyle='-', label='P_rec')
     ax1.plot(P_net.keys(), P_fus.values(), marker='o', linestyle='-', label='P_fus')
 
-    plt.title('Power')
+    ax1.set_title('Power')
     ax1.legend()
     fig.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'power_plot.png'))
+    save_figure(fig, os.path.join(os.path.dirname(workdir), 'power_plot.png'))
 
 def plot_R_major(workdir, var_name=Settings.var_name):
     """
@@ -351,7 +398,8 @@ def plot_R_major(workdir, var_name=Settings.var_name):
     bt = load_results(workdir, var_name, 'b_plasma_toroidal_on_axis')
     rmajor = load_results(workdir, var_name, 'rmajor')
 
-    fig2, ax1 = plt.subplots(figsize=(7, 5))
+    fig2 = Figure(figsize=(7, 5))
+    ax1 = fig2.subplots()
     x = list(bt.keys())
     y2 = list(rmajor.values())
 
@@ -362,25 +410,30 @@ def plot_R_major(workdir, var_name=Settings.var_name):
     ax1.tick_params(axis='y', labelcolor=color2)
     ax1.set_ylim(bottom=min(y2)*0.95, top=max(y2)*1.05)
     
-    set_boxes(ax1)
+    set_boxes(ax1, workdir, var_name)
 
     fig2.tight_layout()
-    plt.savefig(os.path.join(os.path.dirname(workdir), 'R_major_plot.png'))
+    save_figure(fig2, os.path.join(os.path.dirname(workdir), 'R_major_plot.png'))
 
-def set_boxes(ax1, labels=True):
+def set_boxes(ax1, workdir, var_name=Settings.var_name, labels=True):
+    """
+    Shade the constraint regimes of the scan (see constraint_map) and label them.
+    """
     ax1.set_xlim(5, 9.25)
+    xmin, xmax = ax1.get_xlim()
 
     # Add boxes
-    ymin, ymax = ax1.get_ylim()
-    ax1.axvspan(ax1.get_xlim()[0], 6.25, alpha=0.2, color='red')
-    ax1.axvspan(6.25, 6.5, alpha=0.2, color='green')
-    ax1.axvspan(6.5, ax1.get_xlim()[1], alpha=0.2, color='orange')
-    
-    if labels:
-        # Add text labels to each box
-        ax1.text(5.8, 21.3, 'Low field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-        ax1.text(6.35, 21.3, 'Optimal field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
-        ax1.text(6.9, 21.3, 'High field', rotation='vertical', va='top', fontsize=10, fontweight='bold')
+    for region in load_constraint_map(workdir, var_name).regimes():
+        lower, upper = max(region.lower, xmin), min(region.upper, xmax)
+        if lower >= upper:
+            continue
+        ax1.axvspan(lower, upper, alpha=0.2, color=REGIME_COLORS[region.label])
+
+        if labels:
+            # Add text labels to each box
+            label = REGIME_LABELS.get(region.label, ', '.join(region.active))
+            ax1.text(0.5 * (lower + upper), 0.97, label, transform=ax1.get_xaxis_transform(), rotation='vertical',
+                     ha='center', va='top', fontsize=10, fontweight='bold')
 
 if __name__ == "__main__":
 
@@ -0,0 +1,67 @@
+'''
+Refinement criteria for adaptive 1-D scans
+
+An interval between two neighbouring scan points is refined when the
+solver outcome (ifail) differs, when the set of active inequality
+constraints (|ineq_con###| below a tolerance) changes, or when the
+objective jumps by more than a relative threshold.
+'''
+import numpy as np
+
+
+def residual_matrix(table, mask=None):
+    """
+    (cases x constraints) matrix of ineq_con### residuals and the constraint ids.
+    """
+    names = sorted(name for name in table.names if name.startswith('ineq_con'))
+    if mask is None:
+        mask = np.ones(len(table), dtype=bool)
+    if not names:
+        return np.zeros((int(mask.sum()), 0)), []
+    residuals = np.column_stack([table.column(name)[mask] for name in names])
+    return residuals, [name[len('ineq_con'):] for name in names]
+
+
+def active_constraints(residuals, active_tol=1e-3):
+    """
+    Boolean matrix, True where a constraint is active (|residual| < active_tol).
+    """
+    with np.errstate(invalid='ignore'):
+        return np.abs(residuals) < active_tol
+
+
+def refinement_points(table, resolution, mask=None, active_tol=1e-3, objective='norm_objf',
+                      objective_jump=0.02):
+    """
+    New scan values at the midpoints of intervals that need refining.
+    Intervals narrower than 2 * resolution are not split any further, new
+    points are placed on the resolution grid.
+    """
+    if mask is None:
+        mask = np.ones(len(table), dtype=bool)
+    x = table.scan_value[mask]
+    order = np.argsort(x)
+    x = x[order]
+    converged = (table.ifail[mask] == 1)[order]
+    f = table.column(objective)[mask][order]
+    residuals, _ = residual_matrix(table, mask)
+    active = active_constraints(residuals[order], active_tol)
+
+    new_values = set()
+    for i in range(len(x) - 1):
+        if x[i + 1] - x[i] < 2 * resolution * (1 - 1e-9):
+            continue
+        if converged[i] != converged[i + 1]:
+            refine = True
+        elif not converged[i]:
+            refine = False
+        else:
+            scale = max(abs(f[i]), abs(f[i + 1]))
+            jump = abs(f[i + 1] - f[i]) / scale if scale > 0 else 0.0
+            refine = bool(np.any(active[i] != active[i + 1])) or jump > objective_jump
+
+        if refine:
+            mid = round(0.5 * (x[i] + x[i + 1]) / resolution) * resolution
+            if x[i] < mid < x[i + 1]:
+                new_values.add(round(mid, 9))
+    return sorted(new_values)
@@ -0,0 +1,232 @@
+'''
+Benchmark of the scan pipeline on the committed result trees
+
+Every stage of the pipeline is timed on the studies shipped with the
+repository and on synthetic copies of them scaled to more cases:
+
+    generate_inputs      generate_input.write_cases of all cases
+    ingest               mfile_reader.read_values of every MFILE
+    ingest_sidecar       the same from the binary sidecars
+    collect              results_store.collect of the whole scan
+    collect_incremental  results_store.collect with nothing changed
+    plot:<name>          every plot_<name> figure of the make_plots module
+                         of the study
+
+All work happens on a copy of the study in a temporary directory; the
+MFILEs of the copy are hard links to the committed files. A synthetic scan
+of n cases reuses the fixture MFILEs in turn under n evenly spaced scan
+values, so reading and collecting scale with n, while the figures still
+show the values of the fixture cases.
+
+Each run appends one JSON line to the history file (environment, git
+commit and {study, cases, stage, best, median, repeats} per stage) and
+is compared with the last run on the same machine:
+
+    python -m stellarator_analysis.scripts.benchmark --scales 1000 10000
+'''
+from stellarator_analysis.scripts import generate_input, mfile_reader, mfile_sidecar, results_store
+from stellarator_analysis.scripts.case_inputs import link_if_changed
+from contextlib import redirect_stdout
+import matplotlib
+import numpy as np
+import subprocess
+import importlib
+import argparse
+import platform
+import tempfile
+import shutil
+import time
+import json
+import sys
+import io
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+HISTORY = os.path.join(ROOT, 'benchmark_history.jsonl')
+
+# study: (folder of the study, scanned input variable)
+FIXTURES = {'HTS_larger_coil': ('coil_aspect_scan', 'f_st_coil_aspect'),
+            'HTS_new_configuration': ('coil_aspect_scan', 'f_st_coil_aspect'),
+            'HTS_hfact': ('design_space_R_B', 'b_plasma_toroidal_on_axis')}
+PREFIX = 'squid'
+CASE_FILES = (PREFIX + '.IN.DAT', PREFIX + '.MFILE.DAT', PREFIX + '.stella_conf.json')
+
+# Stages are only reported as slower if their median lost at least this many
+# seconds, below that the difference is within the noise of a busy machine
+MIN_SLOWDOWN = 0.05
+
+
+def time_stage(fn, repeats=1, setup=None):
+    """
+    Wall times of repeats calls of fn, each after setup if given. What
+    the stage prints is discarded.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def copy_study(study, dest_dir, n_cases=None):
+    """
+    Copy the template and the cases of a study to dest_dir/study, with
+    n_cases synthetic cases if given. Returns the copied results directory.
+    """
+    folder, _ = FIXTURES[study]
+    study_dir = os.path.join(ROOT, folder, study)
+    results_dir = os.path.join(study_dir, 'results')
+    copy_dir = os.path.join(dest_dir, study)
+    copy_results = os.path.join(copy_dir, 'results')
+    os.makedirs(copy_results)
+    for filename in (PREFIX + '.IN.DAT', PREFIX + '.stella_conf.json'):
+        shutil.copy(os.path.join(study_dir, filename), copy_dir)
+
+    cases = results_store.list_cases(results_dir, PREFIX)
+    if n_cases is None:
+        names = cases
+    else:
+        short_name = cases[0].rsplit('_', 1)[0]
+        values = [results_store.scan_value_from_case(case) for case in cases]
+        names = [generate_input.case_dir_name(short_name, value, 6)
+                 for value in np.linspace(min(values), max(values), n_cases)]
+    for i, name in enumerate(names):
+        os.makedirs(os.path.join(copy_results, name))
+        for filename in CASE_FILES:
+            source = os.path.join(results_dir, cases[i % len(cases)], filename)
+            if os.path.isfile(source):
+                link_if_changed(source, os.path.join(copy_results, name, filename))
+    return copy_results
+
+
+def plot_functions(study):
+    """
+    {name: plot function} of the make_plots module of a study.
+    """
+    module = importlib.import_module(f'stellarator_analysis.{FIXTURES[study][0]}.make_plots')
+    return {name[len('plot_'):]: getattr(module, name) for name in sorted(vars(module))
+            if name.startswith('plot_') and callable(getattr(module, name))}
+
+
+def benchmark_scan(study, results_dir, repeats=1):
+    """
+    {stage: [wall times]} of all stages on the copied results directory.
+    """
+    _, var_name = FIXTURES[study]
+    study_dir = os.path.dirname(results_dir)
+    cases = results_store.list_cases(results_dir, PREFIX)
+    mfiles = [os.path.join(results_dir, case, PREFIX + '.MFILE.DAT') for case in cases]
+    generated_dir = os.path.join(study_dir, 'generated')
+    parameters = {case: {var_name: float(i)} for i, case in enumerate(cases)}
+
+    stages = {}
+    stages['generate_inputs'] = time_stage(
+        lambda: generate_input.write_cases(generated_dir, parameters, PREFIX, study_dir), repeats,
+        setup=lambda: shutil.rmtree(generated_dir, ignore_errors=True))
+    shutil.rmtree(generated_dir)
+    stages['ingest'] = time_stage(lambda: [mfile_reader.read_values(mfile) for mfile in mfiles], repeats)
+    mfile_sidecar.update_sidecars(results_dir, PREFIX)
+    stages['ingest_sidecar'] = time_stage(lambda: [mfile_sidecar.read_values(mfile) for mfile in mfiles], repeats)
+    stages['collect'] = time_stage(lambda: results_store.collect(results_dir, PREFIX, incremental=False), repeats)
+    stages['collect_incremental'] = time_stage(lambda: results_store.collect(results_dir, PREFIX), repeats)
+    for name, plot_fn in plot_functions(study).items():
+        stages['plot:' + name] = time_stage(lambda: plot_fn(results_dir), repeats)
+    return stages
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'machine': platform.node(),
+            'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__, 'cpus': os.cpu_count()}
+
+
+def run(studies=tuple(FIXTURES), scales=(), repeats=3, work_dir=None):
+    """
+    Benchmark every study as committed and scaled to each number of cases
+    in scales, timing every stage repeats times. Returns the history record.
+    """
+    record = environment()
+    record['stages'] = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for study in studies:
+            for n_cases in (None,) + tuple(scales):
+                dest_dir = os.path.join(tmp_dir, str(n_cases or 'fixture'))
+                results_dir = copy_study(study, dest_dir, n_cases)
+                n = len(results_store.list_cases(results_dir, PREFIX))
+                print(f'{study}, {n} cases:')
+                for stage, times in benchmark_scan(study, results_dir, repeats).items():
+                    record['stages'].append({'study': study, 'cases': n, 'stage': stage, 'best': min(times),
+                                             'median': float(np.median(times)), 'repeats': len(times)})
+                    print(f'  {stage:<28} best {min(times):8.3f} s  median {np.median(times):8.3f} s')
+                shutil.rmtree(dest_dir)
+    return record
+
+
+def read_history(path=HISTORY):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(record, path=HISTORY):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def regressions(previous, record, tolerance=0.25):
+    """
+    [(study, cases, stage, previous median, median)] of the stages whose
+    median got slower than previous by more than the fraction tolerance
+    and by at least MIN_SLOWDOWN seconds.
+    """
+    before = {(stage['study'], stage['cases'], stage['stage']): stage['median'] for stage in previous['stages']}
+    slower = []
+    for stage in record['stages']:
+        key = (stage['study'], stage['cases'], stage['stage'])
+        if key in before and stage['median'] > max(before[key] * (1 + tolerance), before[key] + MIN_SLOWDOWN):
+            slower.append(key + (before[key], stage['median']))
+    return slower
+
+
+def main(studies=tuple(FIXTURES), scales=(), repeats=3, history=HISTORY, tolerance=0.25, work_dir=None):
+    """
+    Run the benchmark, append it to history and report the regressions
+    against the last run on this machine. Returns the regressions.
+    """
+    record = run(studies, scales, repeats, work_dir)
+    previous = [old for old in read_history(history) if old['machine'] == record['machine']]
+    append_history(record, history)
+    if not previous:
+        print(f'Benchmark written to {history}, no earlier run on {record["machine"]} to compare with')
+        return []
+    slower = regressions(previous[-1], record, tolerance)
+    print(f'{len(slower)} stages more than {tolerance:.0%} slower than the run of {previous[-1]["time"]} '
+          f'({previous[-1]["commit"]})')
+    for study, n_cases, stage, before, after in slower:
+        print(f'  {study}, {n_cases} cases, {stage}: {before:.3f} s -> {after:.3f} s')
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark', description='Time the scan pipeline on the committed studies')
+    parser.add_argument('--studies', nargs='+', default=list(FIXTURES), choices=list(FIXTURES))
+    parser.add_argument('--scales', nargs='*', type=int, default=[], help='numbers of cases of synthetic scans')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--work-dir', default=None, help='where the temporary copies are made')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+    found = main(args.studies, args.scales, args.repeats, args.history, args.tolerance, args.work_dir)
+    if found and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,199 @@
+'''
+Batched writing of case inputs and the case manifest of a scan
+
+A CaseWriter parses the IN.DAT template of a study once and writes the
+inputs of any number of cases from it:
+
+    <case>/<prefix>.IN.DAT             the template with the case parameters,
+                                       written only if it sets other values
+    <case>/<prefix>.stella_conf.json   hard links to the study's file and to
+    <case>/run_me.py                   scripts/run_me.py (copies if the file
+                                       system does not support links)
+
+An existing run_me.py is the script the case was run with and is kept.
+
+Instead of creating the case directories up front, the cases of a scan can
+be recorded in results/cases.json, {case: parameters} plus the template
+they are generated from. run_cases materialises the directory of such a
+case just before it is run, so a scan of thousands of points takes one
+file until its cases are scheduled.
+'''
+from stellarator_analysis.scripts import indat_model
+import shutil
+import json
+import os
+
+RUN_ME = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'run_me.py')
+MANIFEST_NAME = 'cases.json'
+
+
+def same_content(path_a, path_b):
+    """
+    True if both files exist and have identical content.
+    """
+    if not (os.path.isfile(path_a) and os.path.isfile(path_b)):
+        return False
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    with open(path_a, 'rb') as a, open(path_b, 'rb') as b:
+        return a.read() == b.read()
+
+
+def same_input(path, model):
+    """
+    True if the IN.DAT at path exists and sets the same values as the
+    InDatModel model, whatever its comments and layout.
+    """
+    if not os.path.isfile(path):
+        return False
+    return indat_model.InDatModel.from_file(path).semantic_key() == model.semantic_key()
+
+
+def write_if_changed(path, data):
+    """
+    Write bytes to path unless it already holds them. Returns True if written.
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        pass
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def link_if_changed(source, destination):
+    """
+    Make destination a hard link to source unless it already is one.
+    Falls back to a copy where hard links are not possible, e.g. across
+    file systems. Returns True if destination was replaced.
+    """
+    if os.path.isfile(destination) and os.path.samefile(source, destination):
+        return False
+    tmp_path = destination + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        if same_content(source, destination):
+            return False
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+    return True
+
+
+class CaseWriter:
+    """
+    Writes case directories from the template of a study, parsed once.
+    """
+
+    def __init__(self, prefix, workdir):
+        self.prefix = prefix
+        self.workdir = workdir
+        self.template = indat_model.load_template(os.path.join(workdir, prefix + '.IN.DAT'))
+        self.stella_conf = os.path.join(workdir, prefix + '.stella_conf.json')
+        self.written = 0
+        self.unchanged = 0
+
+    def write(self, case_dir, parameters):
+        """
+        Create or update the input of a single case with {name: value}
+        parameters set in the template and return its directory. An
+        existing input that sets the same values is kept as it is.
+        """
+        os.makedirs(case_dir, exist_ok=True)
+        case_input = self.template.apply(parameters)
+        path = os.path.join(case_dir, self.prefix + '.IN.DAT')
+        if not same_input(path, case_input) and write_if_changed(path, case_input.text().encode()):
+            self.written += 1
+        else:
+            self.unchanged += 1
+        link_if_changed(self.stella_conf, os.path.join(case_dir, self.prefix + '.stella_conf.json'))
+        run_me = os.path.join(case_dir, 'run_me.py')
+        if not os.path.lexists(run_me):
+            link_if_changed(RUN_ME, run_me)
+        return case_dir
+
+    def write_all(self, results_dir, cases):
+        """
+        Write every case of {case: parameters} and return the case directories.
+        """
+        return [self.write(os.path.join(results_dir, case), parameters) for case, parameters in cases.items()]
+
+
+def manifest_path(results_dir):
+    return os.path.join(results_dir, MANIFEST_NAME)
+
+
+_manifests = {}
+
+
+def read_manifest(results_dir):
+    """
+    Manifest of results_dir, {'prefix', 'workdir', 'cases': {case: parameters}},
+    None if the scan has none. Read once per session unless the file changes.
+    """
+    path = manifest_path(results_dir)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    entry = _manifests.get(path)
+    if entry is None or entry[0] != key:
+        with open(path) as f:
+            entry = (key, json.load(f))
+        _manifests[path] = entry
+    return entry[1]
+
+
+def write_manifest(results_dir, prefix, workdir, cases):
+    """
+    Add {case: parameters} to the manifest of results_dir and return the
+    case directories, which are created when the cases are run.
+    """
+    manifest = read_manifest(results_dir) or {'prefix': prefix, 'workdir': os.path.abspath(workdir), 'cases': {}}
+    if manifest['prefix'] != prefix or not os.path.samefile(manifest['workdir'], workdir):
+        raise ValueError(f'{manifest_path(results_dir)} belongs to a scan of {manifest["workdir"]} '
+                         f'with prefix {manifest["prefix"]}')
+    manifest['cases'].update(cases)
+    tmp_path = manifest_path(results_dir) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path(results_dir))
+    return [os.path.join(results_dir, case) for case in cases]
+
+
+def is_materialised(case_dir):
+    return os.path.isfile(os.path.join(case_dir, 'run_me.py'))
+
+
+def manifest_case_dirs(results_dir):
+    """
+    Directories of all cases in the manifest of results_dir, created or not.
+    """
+    manifest = read_manifest(results_dir)
+    if manifest is None:
+        return []
+    return [os.path.join(results_dir, case) for case in manifest['cases']]
+
+
+def materialise(case_dir):
+    """
+    Write the directory of a case recorded in the manifest of its scan,
+    unless it exists already. Returns case_dir.
+    """
+    if is_materialised(case_dir):
+        return case_dir
+    results_dir, case = os.path.split(os.path.normpath(case_dir))
+    manifest = read_manifest(results_dir)
+    if manifest is None or case not in manifest['cases']:
+        raise FileNotFoundError(f'{case_dir} is neither a case directory nor in {manifest_path(results_dir)}')
+    writer = CaseWriter(manifest['prefix'], manifest['workdir'])
+    return writer.write(case_dir, manifest['cases'][case])
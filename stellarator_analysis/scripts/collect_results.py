@@ -0,0 +1,69 @@
+'''
+Collect the results of a scan and plot one output against the scan variable
+
+The MFILEs of all cases of workdir/case_name are collected into the
+columnar results store (see results_store), on a process pool for large
+scans. The converged values of param_y are then printed and plotted
+against param_x into workdir/<param_y>_vs_<param_x>.png. If param_x is
+not an MFILE variable, the scan value of the case names is used.
+'''
+from stellarator_analysis.scripts import results_query, results_store
+from matplotlib.figure import Figure
+import numpy as np
+import argparse
+import os
+
+
+def main(case_name, prefix='squid', param_x=None, param_y='coe', workdir=None, max_workers=None,
+         incremental=True):
+    """
+    Collect workdir/case_name on max_workers processes (default: all CPUs)
+    and plot param_y against param_x. Returns the path of the store.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    results_dir = os.path.join(workdir, case_name)
+    path = results_store.collect(results_dir, prefix, verbose=True, incremental=incremental,
+                                 max_workers=max_workers)
+    if param_y is None:
+        return path
+
+    table = results_store.load(results_dir, prefix, rebuild=False)
+    x_name = param_x if param_x is not None and param_x in table else '_scan_value'
+    if x_name != param_x:
+        print(f'{param_x} not found in the MFILEs, using the scan value of the case names')
+    names = (param_y,) if x_name == '_scan_value' else (x_name, param_y)
+    selection = results_query.open_scan(results_dir, prefix).select(*names).converged().arrays()
+    x, y = selection[x_name], selection[param_y]
+    finite = np.isfinite(x) & np.isfinite(y)
+    order = np.argsort(x[finite], kind='stable')
+    x, y = x[finite][order], y[finite][order]
+
+    print(f'{param_y} of {len(x)} converged cases of {len(table)}:')
+    for key, value in zip(x, y):
+        print(f'{key}: {value}')
+    if not len(x):
+        return path
+
+    fig = Figure(figsize=(7, 5))
+    ax = fig.subplots()
+    ax.plot(x, y, marker='o', linestyle='-')
+    ax.set_xlabel(param_x or 'scan value')
+    ax.set_ylabel(param_y)
+    ax.grid(True)
+    fig.tight_layout()
+    fig.savefig(os.path.join(workdir, f'{param_y}_vs_{param_x or "scan_value"}.png'))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='collect_results', description='Collect a scan and plot one output')
+    parser.add_argument('results_dir')
+    parser.add_argument('-n', '--prefix', default='squid')
+    parser.add_argument('-x', '--param-x', default=None)
+    parser.add_argument('-y', '--param-y', default='coe')
+    parser.add_argument('-j', '--max-workers', type=int, default=None)
+    parser.add_argument('--full', action='store_true', help='parse every MFILE again')
+    args = parser.parse_args()
+    main(os.path.basename(os.path.normpath(args.results_dir)), args.prefix, args.param_x, args.param_y,
+         os.path.dirname(os.path.abspath(args.results_dir)), args.max_workers, not args.full)
@@ -0,0 +1,203 @@
+'''
+Active-constraint map of a 1-D scan
+
+The ineq_con### residuals of the converged cases are gathered in one
+(cases x constraints) matrix (adaptive_scan.residual_matrix) and every
+constraint is active where |residual| < active_tol. Along the scan this
+gives:
+
+    regions      runs of neighbouring cases with the same active set
+    boundaries   scan values where the active set changes, half way between
+                 the neighbouring cases, with the constraints that become
+                 active or inactive there
+    regimes      the scan split in a 'lower', 'transition' and 'upper'
+                 regime: the lower regime is where the constraints binding
+                 at the low end of the scan (and only there) still bind and
+                 none of those of the high end does, the upper regime the
+                 reverse, the transition anything in between
+
+For the B scan of design_space_R_B the regimes are the low field, optimal
+field and high field regions of the figures:
+
+    cmap = constraint_map.from_scan('stellarator_analysis/design_space_R_B/HTS_hfact/results',
+                                    var_name='b_plasma_toroidal_on_axis')
+    cmap.report()
+'''
+from stellarator_analysis.scripts import results_store
+from stellarator_analysis.scripts.adaptive_scan import residual_matrix, active_constraints
+from dataclasses import dataclass
+import numpy as np
+import argparse
+
+
+@dataclass
+class Region:
+    """
+    Interval [lower, upper] of the scan and the constraints active in it.
+    lower and upper are half way to the neighbouring cases, or -inf / inf
+    at the ends of the scan.
+    """
+    lower: float
+    upper: float
+    active: tuple
+    label: str = ''
+    n_cases: int = 0
+
+
+@dataclass
+class Boundary:
+    """
+    Scan value where the active set changes.
+    """
+    value: float
+    entering: tuple
+    leaving: tuple
+
+
+class ConstraintMap:
+    """
+    Active constraints of the converged cases of a scan, sorted by scan value.
+    """
+
+    def __init__(self, scan_value, residuals, constraints, active_tol=1e-3):
+        order = np.argsort(scan_value, kind='stable')
+        self.scan_value = np.asarray(scan_value, dtype=float)[order]
+        self.residuals = residuals[order]
+        self.constraints = list(constraints)
+        self.active_tol = active_tol
+        self.active = active_constraints(self.residuals, active_tol)
+
+    def __len__(self):
+        return len(self.scan_value)
+
+    def active_set(self, row):
+        return tuple(c for c, is_active in zip(self.constraints, self.active[row]) if is_active)
+
+    def ever_active(self):
+        """
+        Constraints active in at least one case.
+        """
+        return [c for c, is_active in zip(self.constraints, self.active.any(axis=0)) if is_active]
+
+    def edges(self):
+        """
+        Region edges of every case: half way to its neighbours, -inf / inf at the ends.
+        """
+        middle = 0.5 * (self.scan_value[1:] + self.scan_value[:-1])
+        return np.concatenate([[-np.inf], middle]), np.concatenate([middle, [np.inf]])
+
+    def runs(self, keys):
+        """
+        Regions of the runs of neighbouring cases with equal keys (one per case).
+        """
+        lower, upper = self.edges()
+        regions = []
+        start = 0
+        for i in range(1, len(self) + 1):
+            if i == len(self) or keys[i] != keys[start]:
+                regions.append(Region(float(lower[start]), float(upper[i - 1]), self.active_set(start),
+                                      n_cases=i - start))
+                start = i
+        return regions
+
+    def regions(self):
+        """
+        Regions of constant active set.
+        """
+        changed = np.concatenate([[False], np.any(self.active[1:] != self.active[:-1], axis=1)])
+        return self.runs(np.cumsum(changed))
+
+    def boundaries(self):
+        """
+        Boundaries between neighbouring cases whose active sets differ.
+        """
+        _, upper = self.edges()
+        found = []
+        for i in np.flatnonzero(np.any(self.active[1:] != self.active[:-1], axis=1)):
+            entering = self.active[i + 1] & ~self.active[i]
+            leaving = self.active[i] & ~self.active[i + 1]
+            found.append(Boundary(float(upper[i]),
+                                  tuple(c for c, e in zip(self.constraints, entering) if e),
+                                  tuple(c for c, e in zip(self.constraints, leaving) if e)))
+        return found
+
+    def regime_labels(self):
+        """
+        'lower', 'transition' or 'upper' of every case, or 'uniform' for
+        all cases if the active sets at both ends of the scan are the same.
+        """
+        if not len(self):
+            return []
+        lower_only = self.active[0] & ~self.active[-1]
+        upper_only = self.active[-1] & ~self.active[0]
+        if not lower_only.any() and not upper_only.any():
+            return ['uniform'] * len(self)
+        has_lower = np.all(self.active[:, lower_only], axis=1)
+        has_upper = np.all(self.active[:, upper_only], axis=1)
+        any_lower = np.any(self.active[:, lower_only], axis=1)
+        any_upper = np.any(self.active[:, upper_only], axis=1)
+        labels = np.full(len(self), 'transition', dtype=object)
+        labels[has_lower & ~any_upper] = 'lower'
+        labels[has_upper & ~any_lower] = 'upper'
+        return labels.tolist()
+
+    def regimes(self):
+        """
+        Regions of neighbouring cases of the same regime_labels. The active
+        set of a regime is that of the constraints active in all its cases.
+        """
+        labels = self.regime_labels()
+        regions = self.runs(labels)
+        start = 0
+        for region in regions:
+            common = np.all(self.active[start:start + region.n_cases], axis=0)
+            region.active = tuple(c for c, is_active in zip(self.constraints, common) if is_active)
+            region.label = labels[start]
+            start += region.n_cases
+        return regions
+
+    def report(self):
+        """
+        Print the active set of every region and the boundaries between them.
+        """
+        print(f'{len(self)} converged cases, {len(self.constraints)} constraints, '
+              f'active where |residual| < {self.active_tol:g}')
+        print(f'Active somewhere: {", ".join(self.ever_active()) or "none"}')
+        for region in self.regions():
+            print(f'  {region.lower:>10.4g} .. {region.upper:<10.4g} {region.n_cases:3d} cases: '
+                  f'{", ".join(region.active) or "none"}')
+        for boundary in self.boundaries():
+            print(f'  boundary at {boundary.value:.4g}: +[{", ".join(boundary.entering)}] '
+                  f'-[{", ".join(boundary.leaving)}]')
+        for region in self.regimes():
+            print(f'  {region.label:<10} {region.lower:>10.4g} .. {region.upper:<10.4g} '
+                  f'binding: {", ".join(region.active) or "none"}')
+
+
+def build(table, var_name=None, active_tol=1e-3):
+    """
+    ConstraintMap of the converged cases of a ResultsTable over var_name,
+    by default the scan value of the case names.
+    """
+    mask = table.ifail == 1
+    scan_value = table.scan_value if var_name is None else table.column(var_name)
+    mask &= np.isfinite(scan_value)
+    residuals, constraints = residual_matrix(table, mask)
+    return ConstraintMap(scan_value[mask], residuals, constraints, active_tol)
+
+
+def from_scan(results_dir, prefix='squid', var_name=None, active_tol=1e-3):
+    """
+    ConstraintMap of the results store of a scan.
+    """
+    return build(results_store.load(results_dir, prefix), var_name, active_tol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='constraint_map', description='Active constraints along a scan')
+    parser.add_argument('results_dir')
+    parser.add_argument('-n', '--prefix', default='squid')
+    parser.add_argument('--var-name', default=None, help='column to use as scan axis (default: case names)')
+    parser.add_argument('--active-tol', type=float, default=1e-3)
+    args = parser.parse_args()
+    from_scan(args.results_dir, args.prefix, args.var_name, args.active_tol).report()
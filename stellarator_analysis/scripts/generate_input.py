@@ -0,0 +1,136 @@
+'''
+Generate the case directories of a 1-D scan from the template input of a study
+
+Every case gets results/<var_short_name>_<value>/ with run_me.py, the IN.DAT
+template with the scanned variable set, and the stella_conf.json, see
+case_inputs. Without materialise only results/cases.json is written and the
+case directories are created when the cases are run.
+In adaptive mode a coarse grid is run first and new points are only inserted
+where the active constraint set or the objective changes between neighbours.
+'''
+from stellarator_analysis.scripts.case_inputs import CaseWriter
+from stellarator_analysis.scripts import adaptive_scan, case_inputs, results_store, run_cases
+import numpy as np
+import shutil
+import os
+
+
+def scan_values(var_min, var_max, step, decimals=2):
+    """
+    Values from var_min to var_max (inclusive) in steps of step.
+    """
+    n = int(np.floor((var_max - var_min) / step + 1e-9)) + 1
+    return [round(var_min + i * step, decimals + 6) for i in range(n)]
+
+
+def case_dir_name(var_short_name, value, decimals=2):
+    """
+    Name of the directory of a case, e.g. 'Ac_0.80'.
+    """
+    return f'{var_short_name}_{value:.{decimals}f}'
+
+
+def write_case(results_dir, case, prefix, workdir, parameters):
+    """
+    Create or update the input of a single case with {name: value}
+    parameters set in the template and return its directory. The template
+    is parsed once and patched, so the case keeps its layout and comments.
+    """
+    return CaseWriter(prefix, workdir).write(os.path.join(results_dir, case), parameters)
+
+
+def write_cases(results_dir, cases, prefix, workdir, materialise=True):
+    """
+    Write the inputs of {case: parameters} in one pass over a single parsed
+    template and return the case directories. Without materialise the cases
+    are added to the manifest and only those whose directory exists already
+    are updated, the others are created by run_cases when they are run.
+    """
+    writer = CaseWriter(prefix, workdir)
+    if materialise:
+        return writer.write_all(results_dir, cases)
+    case_dirs = case_inputs.write_manifest(results_dir, prefix, workdir, cases)
+    writer.write_all(results_dir, {case: parameters for case, parameters in cases.items()
+                                   if case_inputs.is_materialised(os.path.join(results_dir, case))})
+    return case_dirs
+
+
+def generate(values, results_dir, prefix, workdir, var_name, var_short_name, decimals=2, materialise=True):
+    """
+    Write the inputs of all values and return the case directories.
+    """
+    cases = {case_dir_name(var_short_name, value, decimals): {var_name: value} for value in values}
+    return write_cases(results_dir, cases, prefix, workdir, materialise)
+
+
+def decimals_for(resolution):
+    """
+    Number of decimals needed to give every point of a grid with spacing
+    resolution its own directory name (at least 2).
+    """
+    return max(2, int(np.ceil(-np.log10(resolution) - 1e-9)))
+
+
+def run_adaptive(case_dirs, results_dir, prefix, workdir, var_name, var_short_name, var_min, var_max,
+                 resolution, max_workers=None, materialise=True, **refine_options):
+    """
+    Run case_dirs, then keep inserting points where the scan needs refining
+    until every flagged interval is narrower than resolution.
+    Returns all case directories of the scan.
+    """
+    decimals = decimals_for(resolution)
+    all_dirs = list(case_dirs)
+    new_dirs = list(case_dirs)
+    level = 0
+    while new_dirs:
+        print(f'Adaptive scan level {level}: running {len(new_dirs)} cases')
+        run_cases.run_all(new_dirs, prefix=prefix, max_workers=max_workers, var_name=var_name)
+
+        table = results_store.load(results_dir, prefix)
+        in_scan = np.array([case.startswith(var_short_name + '_') for case in table.cases])
+        new_values = adaptive_scan.refinement_points(table, resolution, mask=in_scan, **refine_options)
+        new_values = [value for value in new_values if var_min <= value <= var_max]
+        new_dirs = generate(new_values, results_dir, prefix, workdir, var_name, var_short_name, decimals,
+                            materialise)
+        all_dirs += new_dirs
+        level += 1
+
+    print(f'Adaptive scan finished after {level} levels with {len(all_dirs)} cases')
+    return all_dirs
+
+
+def main(case_name, prefix='squid', var_name=None, var_min=None, var_max=None, step=None, workdir=None,
+         clean_start=False, var_short_name=None, adaptive=False, resolution=None, max_workers=None,
+         materialise=True, **refine_options):
+    """
+    Generate the inputs of a scan of var_name from var_min to var_max.
+    The template is workdir/<prefix>.IN.DAT. With clean_start the results
+    directory is removed first. Without materialise the cases are only
+    listed in results/cases.json and their directories are created by
+    run_cases just before each case runs.
+
+    With adaptive, step is the coarse grid spacing and the cases are run
+    here (run_cases.main is not needed afterwards); points are added until
+    the flagged intervals are narrower than resolution. refine_options are
+    passed to adaptive_scan.refinement_points.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    if var_short_name is None:
+        var_short_name = var_name
+    results_dir = os.path.join(workdir, case_name)
+    if clean_start and os.path.isdir(results_dir):
+        shutil.rmtree(results_dir)
+    os.makedirs(results_dir, exist_ok=True)
+
+    decimals = decimals_for(step)
+    case_dirs = generate(scan_values(var_min, var_max, step, decimals), results_dir, prefix, workdir,
+                         var_name, var_short_name, decimals, materialise)
+    where = results_dir if materialise else case_inputs.manifest_path(results_dir)
+    print(f'Generated {len(case_dirs)} cases in {where}')
+
+    if adaptive:
+        case_dirs = run_adaptive(case_dirs, results_dir, prefix, workdir, var_name, var_short_name,
+                                 var_min, var_max, resolution or step / 8, max_workers, materialise,
+                                 **refine_options)
+    return case_dirs
@@ -0,0 +1,221 @@
+'''
+N-dimensional scans, e.g. b_plasma_toroidal_on_axis x hfact x f_st_coil_aspect
+
+Points are taken from the Cartesian product of the scan dimensions or from
+a Latin hypercube sample of it. Cases are run in waves through run_cases,
+starting from a coarse sub-lattice; points whose finished neighbours all
+failed are pruned without running. Results are collected into one dense
+N-D array per variable, NaN where a point was not run or did not converge.
+'''
+from stellarator_analysis.scripts import generate_input, results_store, run_cases
+from dataclasses import dataclass, asdict
+import numpy as np
+import itertools
+import shutil
+import json
+import os
+
+
+@dataclass
+class ScanDimension:
+    """
+    One axis of a grid scan.
+    """
+    var_name: str
+    var_min: float
+    var_max: float
+    step: float
+    var_short_name: str = None
+
+    def __post_init__(self):
+        if self.var_short_name is None:
+            self.var_short_name = self.var_name
+
+    @property
+    def decimals(self):
+        return generate_input.decimals_for(self.step)
+
+    def values(self):
+        return generate_input.scan_values(self.var_min, self.var_max, self.step, self.decimals)
+
+
+def cartesian(dimensions):
+    """
+    Grid indices of every point of the Cartesian product of the dimensions.
+    """
+    return list(itertools.product(*(range(len(dim.values())) for dim in dimensions)))
+
+
+def latin_hypercube(dimensions, n_samples, seed=0):
+    """
+    Grid indices of a Latin hypercube sample with n_samples points: every
+    dimension is split into n_samples strata, one point is drawn per stratum
+    and snapped to the grid of that dimension. Duplicates are removed.
+    """
+    if n_samples is None or int(n_samples) != n_samples or n_samples < 1:
+        raise ValueError(f'A Latin hypercube design needs n_samples, a positive integer, got {n_samples!r}')
+    n_samples = int(n_samples)
+    rng = np.random.default_rng(seed)
+    columns = []
+    for dim in dimensions:
+        n_values = len(dim.values())
+        strata = (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+        columns.append(np.minimum((strata * n_values).astype(int), n_values - 1))
+    return sorted(set(zip(*(column.tolist() for column in columns))))
+
+
+def point_name(dimensions, index):
+    """
+    Directory name of a grid point, e.g. 'B_6.00_hfact_1.10'.
+    """
+    return '_'.join(generate_input.case_dir_name(dim.var_short_name, dim.values()[i], dim.decimals)
+                    for dim, i in zip(dimensions, index))
+
+
+def neighbours(index, shape):
+    """
+    All grid points within one step of index in every dimension.
+    """
+    for offset in itertools.product((-1, 0, 1), repeat=len(index)):
+        if any(offset):
+            neighbour = tuple(i + o for i, o in zip(index, offset))
+            if all(0 <= i < n for i, n in zip(neighbour, shape)):
+                yield neighbour
+
+
+def write_manifest(results_dir, dimensions, points):
+    """
+    Store the dimensions and the case name of every grid point.
+    """
+    manifest = {'dimensions': [asdict(dim) for dim in dimensions],
+                'cases': {point_name(dimensions, index): list(index) for index in points}}
+    with open(os.path.join(results_dir, 'grid.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def read_manifest(results_dir):
+    """
+    Dimensions and {case: grid index} of a grid scan.
+    """
+    with open(os.path.join(results_dir, 'grid.json')) as f:
+        manifest = json.load(f)
+    dimensions = [ScanDimension(**dim) for dim in manifest['dimensions']]
+    return dimensions, {case: tuple(index) for case, index in manifest['cases'].items()}
+
+
+def run_grid(results_dir, prefix, dimensions, points, max_workers=None, prune_min=2, **run_options):
+    """
+    Run the grid points in waves and return {index: status} with status
+    'converged', 'failed' or 'pruned'.
+
+    The first wave is the sub-lattice of even indices. Every further wave
+    holds the pending points next to a finished one; a pending point is
+    pruned once at least prune_min of its neighbours finished and none of
+    them converged.
+    """
+    shape = tuple(len(dim.values()) for dim in dimensions)
+    # Retries and warm starts take the nearest converged point over all
+    # dimensions, in grid steps, and never overwrite a scanned variable
+    positions = {point_name(dimensions, index): index for index in points}
+    run_options.setdefault('var_name', [dim.var_name for dim in dimensions])
+    pending = set(points)
+    status = {}
+
+    wave = [index for index in points if all(i % 2 == 0 for i in index)] or list(points)
+    while wave:
+        pending -= set(wave)
+        case_dirs = [os.path.join(results_dir, point_name(dimensions, index)) for index in wave]
+        print(f'Grid scan: running {len(wave)} points, {len(pending)} pending')
+        run_cases.run_all(case_dirs, prefix=prefix, max_workers=max_workers, positions=positions, **run_options)
+        for index, case_dir in zip(wave, case_dirs):
+            status[index] = 'converged' if run_cases.is_converged(case_dir, prefix) else 'failed'
+
+        wave = []
+        for index in sorted(pending):
+            finished = [status[n] for n in neighbours(index, shape) if n in status]
+            if len(finished) >= prune_min and 'converged' not in finished:
+                status[index] = 'pruned'
+            elif finished:
+                wave.append(index)
+        pending -= {index for index, value in status.items() if value == 'pruned'}
+        if not wave and pending:
+            wave = sorted(pending)
+
+    pruned = sum(value == 'pruned' for value in status.values())
+    print(f'Grid scan: {len(status) - pruned} points run, {pruned} pruned')
+    return status
+
+
+def dense(table, dimensions, cases, names, converged_only=True):
+    """
+    {name: N-D array} over the grid for every variable in names, plus
+    'ifail' (-1 where a point was not run).
+    """
+    shape = tuple(len(dim.values()) for dim in dimensions)
+    rows = {case: row for row, case in enumerate(table.cases)}
+    found = [(index, rows[case]) for case, index in cases.items() if case in rows]
+    grid_index = tuple(np.array([index[d] for index, _ in found], dtype=int) for d in range(len(shape)))
+    row_index = np.array([row for _, row in found], dtype=int)
+
+    ifail = np.full(shape, -1, dtype=np.int64)
+    ifail[grid_index] = table.ifail[row_index]
+    arrays = {'ifail': ifail}
+    for name in names:
+        if name == 'ifail':
+            continue
+        values = np.full(shape, np.nan)
+        values[grid_index] = table.column(name)[row_index]
+        if converged_only:
+            values[ifail != 1] = np.nan
+        arrays[name] = values
+    return arrays
+
+
+def collect_grid(results_dir, prefix='squid', names=None, converged_only=True):
+    """
+    Collect a grid scan into <prefix>.grid.npz with one dense array per
+    variable (all numeric variables if names is None) and the axis values
+    as 'axis_<var_name>'. Returns the arrays.
+    """
+    dimensions, cases = read_manifest(results_dir)
+    table = results_store.load(results_dir, prefix)
+    if names is None:
+        names = [name for name in table.names if table[name].dtype.kind == 'f']
+    arrays = dense(table, dimensions, cases, names, converged_only)
+    for dim in dimensions:
+        arrays['axis_' + dim.var_name] = np.array(dim.values())
+    np.savez(os.path.join(results_dir, prefix + '.grid.npz'), **arrays)
+    return arrays
+
+
+def main(case_name, prefix='squid', dimensions=(), workdir=None, design='cartesian', n_samples=None,
+         seed=0, clean_start=False, max_workers=None, prune_min=2, **run_options):
+    """
+    Generate, run and collect an N-D scan over dimensions (ScanDimension or
+    dicts with its fields). design is 'cartesian' or 'latin_hypercube'
+    with n_samples points (required for it).
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    dimensions = [dim if isinstance(dim, ScanDimension) else ScanDimension(**dim) for dim in dimensions]
+    if design == 'cartesian':
+        points = cartesian(dimensions)
+    elif design == 'latin_hypercube':
+        points = latin_hypercube(dimensions, n_samples, seed)
+    else:
+        raise ValueError(f'Unknown design {design}')
+
+    results_dir = os.path.join(workdir, case_name)
+    if clean_start and os.path.isdir(results_dir):
+        shutil.rmtree(results_dir)
+    os.makedirs(results_dir, exist_ok=True)
+
+    cases = {point_name(dimensions, index): {dim.var_name: dim.values()[i] for dim, i in zip(dimensions, index)}
+             for index in points}
+    generate_input.write_cases(results_dir, cases, prefix, workdir)
+    write_manifest(results_dir, dimensions, points)
+    print(f'Generated {len(points)} grid points in {results_dir}')
+
+    run_grid(results_dir, prefix, dimensions, points, max_workers, prune_min, **run_options)
+    return collect_grid(results_dir, prefix)
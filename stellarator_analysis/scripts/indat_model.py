@@ -0,0 +1,310 @@
+'''
+In-memory model of a PROCESS IN.DAT with semantic diff and patch
+
+The model keeps the lines of the file as they are, so a patched file has
+the layout and comments of its template and a textual diff between two
+cases shows only what really differs. On top of the lines it indexes
+
+    icc       constraint equations, in order
+    ixc       iteration variables, in order
+    values    every other assignment, e.g. 'rmajor', 'boundl(2)' or
+              'f_nd_impurity_electrons(14)', keyed by lower case name
+
+Values are kept as written. Two values are equal if both are numbers with
+the same value (3.005E19 == 3.005d19) or the same text ignoring case.
+'''
+from dataclasses import dataclass, field
+import hashlib
+import json
+import os
+import re
+
+LIST_NAMES = ('icc', 'ixc')
+ARRAY_PATTERN = re.compile(r'^(\w+)\s*\(\s*(\d+)\s*\)$')
+
+
+def normalise_name(name):
+    """
+    Lower case name with array indices written without padding, boundl( 02 ) -> boundl(2).
+    """
+    name = name.strip().lower()
+    match = ARRAY_PATTERN.match(name)
+    if match:
+        return f'{match.group(1)}({int(match.group(2))})'
+    return name
+
+
+def as_number(value):
+    try:
+        return float(str(value).strip().lower().replace('d', 'e'))
+    except ValueError:
+        return None
+
+
+def same_value(a, b):
+    x, y = as_number(a), as_number(b)
+    if x is not None and y is not None:
+        return x == y
+    return str(a).strip().lower() == str(b).strip().lower()
+
+
+def format_value(value):
+    """
+    IN.DAT text of a Python value.
+    """
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def split_line(line):
+    """
+    (code, comment) of a line; comment includes the leading '*'.
+    """
+    star = line.find('*')
+    if star < 0:
+        return line, ''
+    return line[:star], line[star:]
+
+
+@dataclass
+class InDatPatch:
+    """
+    Semantic difference between two IN.DAT files.
+    """
+    set: dict = field(default_factory=dict)
+    unset: list = field(default_factory=list)
+    icc: list = None
+    ixc: list = None
+
+    def __bool__(self):
+        return bool(self.set or self.unset or self.icc is not None or self.ixc is not None)
+
+    def describe(self, base=None):
+        """
+        One line per change, with the old values if the base model is given.
+        """
+        lines = []
+        for name in ('icc', 'ixc'):
+            new = getattr(self, name)
+            if new is not None:
+                old = getattr(base, name) if base is not None else None
+                added = [n for n in new if old is None or n not in old]
+                removed = [n for n in old if n not in new] if old is not None else []
+                lines.append(f'{name}: ' + ', '.join([f'+{n}' for n in added] + [f'-{n}' for n in removed]
+                                                     or ['reordered']))
+        for name, value in self.set.items():
+            old = base.get(name) if base is not None else None
+            lines.append(f'{name}: {old} -> {value}' if old is not None else f'{name}: {value}')
+        for name in self.unset:
+            lines.append(f'{name}: removed')
+        return lines
+
+
+class InDatModel:
+    """
+    Parsed IN.DAT. Mutating methods keep the original lines and layout.
+    """
+
+    def __init__(self, lines, final_newline=True):
+        self.lines = list(lines)
+        self.final_newline = final_newline
+        self._index()
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(text.splitlines(), final_newline=text.endswith('\n') or not text)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls.from_text(f.read())
+
+    def _index(self):
+        self.icc = []
+        self.ixc = []
+        self.values = {}
+        self._list_lines = {name: [] for name in LIST_NAMES}
+        self._value_lines = {}
+        for i, line in enumerate(self.lines):
+            code, _ = split_line(line)
+            if '=' not in code:
+                continue
+            name, value = code.split('=', 1)
+            name = normalise_name(name)
+            if not name:
+                continue
+            value = value.strip()
+            if name in LIST_NAMES:
+                getattr(self, name).append(int(as_number(value)))
+                self._list_lines[name].append(i)
+            else:
+                self.values[name] = value
+                self._value_lines[name] = i
+
+    def copy(self):
+        """
+        Independent copy, without parsing the lines again.
+        """
+        model = InDatModel.__new__(InDatModel)
+        model.lines = list(self.lines)
+        model.final_newline = self.final_newline
+        model.icc = list(self.icc)
+        model.ixc = list(self.ixc)
+        model.values = dict(self.values)
+        model._list_lines = {name: list(lines) for name, lines in self._list_lines.items()}
+        model._value_lines = dict(self._value_lines)
+        return model
+
+    def text(self):
+        return '\n'.join(self.lines) + ('\n' if self.final_newline else '')
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.text())
+
+    def get(self, name, default=None):
+        return self.values.get(normalise_name(name), default)
+
+    def __contains__(self, name):
+        return normalise_name(name) in self.values
+
+    def set(self, name, value):
+        """
+        Set a value in place, keeping the alignment of its comment. New
+        names are appended at the end of the file.
+        """
+        key = normalise_name(name)
+        value = format_value(value)
+        if key in self._value_lines:
+            i = self._value_lines[key]
+            code, comment = split_line(self.lines[i])
+            written_name = code.split('=', 1)[0].rstrip()
+            new_code = f'{written_name} = {value}'
+            if comment:
+                new_code = new_code.ljust(len(code) - 1) + ' '
+            self.lines[i] = new_code + comment
+        else:
+            self.lines.append(f'{name} = {value}')
+            self._value_lines[key] = len(self.lines) - 1
+        self.values[key] = value
+
+    def unset(self, name):
+        key = normalise_name(name)
+        if key in self._value_lines:
+            del self.lines[self._value_lines[key]]
+            self._index()
+
+    def set_list(self, name, numbers):
+        """
+        Replace the icc or ixc entries by numbers. The lines of entries that
+        stay are reused in place, lines of removed entries are deleted and
+        new entries are inserted after the entry they follow in numbers.
+        """
+        numbers = [int(n) for n in numbers]
+        old = getattr(self, name)
+        if numbers == old:
+            return
+        positions = self._list_lines[name]
+        entry_lines = {}
+        for n, i in zip(old, positions):
+            entry_lines.setdefault(n, self.lines[i])
+        kept = [n for n in numbers if n in entry_lines]
+        slots = sorted(i for n, i in zip(old, positions) if n in numbers)[:len(kept)]
+        slot_lines = dict(zip(slots, (entry_lines[n] for n in kept)))
+
+        # New entries go after the slot of the kept entry before them, or
+        # before the first slot (after the last old entry if none is kept)
+        inserts_after = {}
+        previous = None
+        default = max(positions) if positions else len(self.lines) - 1
+        for n in numbers:
+            if n in entry_lines:
+                previous = slots[kept.index(n)]
+            else:
+                at = previous if previous is not None else (slots[0] - 1 if slots else default)
+                inserts_after.setdefault(at, []).append(f'{name} = {n}')
+
+        lines = inserts_after.get(-1, [])
+        for i, line in enumerate(self.lines):
+            if i in slot_lines:
+                lines.append(slot_lines[i])
+            elif i not in positions:
+                lines.append(line)
+            lines.extend(inserts_after.get(i, []))
+        self.lines = lines
+        self._index()
+
+    def diff(self, other):
+        """
+        InDatPatch that turns this model into other.
+        """
+        patch = InDatPatch()
+        for name, value in other.values.items():
+            if name not in self.values or not same_value(self.values[name], value):
+                patch.set[name] = value
+        patch.unset = [name for name in self.values if name not in other.values]
+        if self.icc != other.icc:
+            patch.icc = list(other.icc)
+        if self.ixc != other.ixc:
+            patch.ixc = list(other.ixc)
+        return patch
+
+    def apply(self, patch):
+        """
+        New model with the patch (an InDatPatch or a {name: value} dict) applied.
+        """
+        if isinstance(patch, dict):
+            patch = InDatPatch(set=patch)
+        model = self.copy()
+        for name in ('icc', 'ixc'):
+            if getattr(patch, name) is not None:
+                model.set_list(name, getattr(patch, name))
+        for name in patch.unset:
+            model.unset(name)
+        for name, value in patch.set.items():
+            model.set(name, value)
+        return model
+
+    def semantic_key(self):
+        """
+        SHA-256 of the content that matters to PROCESS: the sets of icc and
+        ixc entries and all values, independent of layout, comments and
+        order (process.io.in_dat writes the entries in its own order).
+        """
+        values = {name: (as_number(value) if as_number(value) is not None else value.lower())
+                  for name, value in self.values.items()}
+        content = json.dumps({'icc': sorted(self.icc), 'ixc': sorted(self.ixc), 'values': values}, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+
+_templates = {}
+
+
+def load_template(path):
+    """
+    Parsed model of a template, parsed once per session unless the file changes.
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    entry = _templates.get(path)
+    if entry is None or entry[0] != key:
+        entry = (key, InDatModel.from_file(path))
+        _templates[path] = entry
+    return entry[1]
+
+
+def diff_files(path_a, path_b):
+    """
+    Semantic differences between two IN.DAT files, one per line.
+    """
+    a = InDatModel.from_file(path_a)
+    return a.diff(InDatModel.from_file(path_b)).describe(a)
+
+
+if __name__ == '__main__':
+    import sys
+    for line in diff_files(sys.argv[1], sys.argv[2]):
+        print(line)
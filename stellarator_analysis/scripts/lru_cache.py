@@ -0,0 +1,94 @@
+'''
+Size-bounded LRU cache with hit, miss and eviction counters
+'''
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Mapping that keeps at most max_size units of values, evicting the least
+    recently used entries first. sizeof gives the size of a value (1 per
+    entry by default), on_evict is called with (key, value) of every
+    evicted entry, e.g. to close a file.
+    """
+
+    def __init__(self, max_size, sizeof=None, on_evict=None, name='cache'):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.name = name
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def values(self):
+        """
+        Cached values from least to most recently used, without counting lookups.
+        """
+        return [value for value, _ in self._entries.values()]
+
+    def get(self, key, default=None):
+        """
+        Value of key, marking it as most recently used. Counts a hit or a miss.
+        """
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Store value under key and evict entries until the cache fits.
+        The newest entry is always kept, even if it alone exceeds max_size.
+        """
+        self.discard(key)
+        size = self.sizeof(value)
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size and len(self._entries) > 1:
+            old_key, (old_value, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def discard(self, key):
+        """
+        Remove key without counting an eviction.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        """
+        Drop all entries and reset the counters.
+        """
+        if self.on_evict is not None:
+            for key, (value, _) in self._entries.items():
+                self.on_evict(key, value)
+        self._entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        print(f'{self.name}: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), '
+              f'{self.evictions} evictions, {len(self._entries)} entries using {self.size} of {self.max_size}')
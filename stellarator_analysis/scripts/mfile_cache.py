@@ -0,0 +1,77 @@
+'''
+Session-scoped cache of parsed MFILE.DAT files used by the plotting scripts
+'''
+from stellarator_analysis.scripts.lru_cache import LRUCache
+import os
+import time
+
+
+class MFileCache:
+    """
+    Cache of parsed MFile objects.
+    Entries are keyed by the real path of the file and validated against its
+    modification time and size, so every MFILE.DAT is parsed only once per
+    session unless it changes on disk or is evicted. At most max_entries
+    parsed files are kept, the least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_entries=256):
+        self._entries = LRUCache(max_entries, name='MFILE cache')
+        self.hits = 0
+        self.misses = 0
+        self.cold_time = 0.0
+        self.warm_time = 0.0
+
+    def get(self, filename):
+        """
+        Return the parsed MFile for filename, parsing it on the first request.
+        """
+        start = time.perf_counter()
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            self.warm_time += time.perf_counter() - start
+            return entry[1]
+
+        # Imported here so that modules using the cache load without PROCESS
+        from process.io.mfile import MFile
+        m = MFile(filename=path)
+        self._entries.put(path, (key, m))
+        self.misses += 1
+        self.cold_time += time.perf_counter() - start
+        return m
+
+    def clear(self):
+        """
+        Drop all cached files and reset the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.cold_time = 0.0
+        self.warm_time = 0.0
+
+    def report(self):
+        """
+        Print cold (parsing) and warm (cached lookup) timings.
+        """
+        print(f'MFILE cache: {self.misses} files parsed in {self.cold_time:.2f} s (cold), '
+              f'{self.hits} lookups served from cache in {self.warm_time:.3f} s (warm), '
+              f'{self._entries.evictions} evicted')
+        if self.misses:
+            saved = self.hits * self.cold_time / self.misses
+            print(f'MFILE cache: ~{saved:.2f} s of re-parsing avoided')
+
+
+mfile_cache = MFileCache()
+
+
+def get_mfile(filename):
+    """
+    Return the parsed MFile for filename from the session cache.
+    """
+    return mfile_cache.get(filename)
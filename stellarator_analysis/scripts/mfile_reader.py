@@ -0,0 +1,119 @@
+'''
+Streaming reader for the scalar values of an MFILE.DAT
+
+The file is scanned line by line and only the values of the requested
+variables are converted, so the ~2,000 pres_plasma_*_profileNN lines never
+become objects. Reading stops as soon as every requested variable is found,
+and always at the copy of the input file at the end. Unlike
+process.io.mfile.MFile this does not import the process package.
+
+Every MFILE line with a value has the form
+    Description_with_underscores______ (varname)_______ value [OP]
+'''
+import time
+
+INPUT_COPY = '# Copy of PROCESS Input Follows #'
+
+
+class ReaderStats:
+    """
+    Counters of files and lines read in this session.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.lines = 0
+        self.time = 0.0
+
+    def report(self):
+        print(f'MFILE reader: {self.files} files, {self.lines} lines read in {self.time:.2f} s')
+
+
+reader_stats = ReaderStats()
+
+
+def parse_value(text):
+    """
+    Convert the value field of an MFILE line to int, float or str.
+    """
+    text = text.lstrip('_').strip()
+    if text.startswith('"'):
+        end = text.find('"', 1)
+        return text[1:end if end > 0 else None].strip()
+    token = text.split(maxsplit=1)[0] if text else ''
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def variable_name(line):
+    """
+    (name, index after the closing bracket) of an MFILE line, (None, -1) if
+    the line holds no variable. Names may contain brackets themselves,
+    e.g. f_nd_impurity_electrons(01).
+    """
+    start = line.find(' (')
+    if start < 0:
+        return None, -1
+    end = line.find(')_', start)
+    if end < 0:
+        end = line.find(') ', start)
+    if end < 0:
+        return None, -1
+    return line[start + 2:end], end + 1
+
+
+def parse_lines(lines, names=None):
+    """
+    {name: value} and the number of lines consumed from an iterable of
+    MFILE lines, see read_values.
+    """
+    wanted = set(names) if names is not None else None
+    values = {}
+    repeated = set()
+    n_lines = 0
+    for line in lines:
+        n_lines += 1
+        if line.startswith('#'):
+            if line.startswith(INPUT_COPY):
+                break
+            continue
+        name, end = variable_name(line)
+        if name is None:
+            continue
+        if wanted is None:
+            if name in values:
+                repeated.add(name)
+            else:
+                values[name] = parse_value(line[end:])
+        elif name in wanted and name not in values:
+            values[name] = parse_value(line[end:])
+            if len(values) == len(wanted):
+                break
+
+    for name in repeated:
+        del values[name]
+    return values, n_lines
+
+
+def read_values(filename, names=None):
+    """
+    Read {name: value} from an MFILE.
+
+    With names, only those variables are converted and reading stops once
+    all of them were found; variables not in the file are missing from the
+    result. Without names, every variable that occurs exactly once (i.e.
+    is not part of a multi-point scan) is returned.
+    """
+    start_time = time.perf_counter()
+    with open(filename, errors='replace') as f:
+        values, n_lines = parse_lines(f, names)
+    reader_stats.files += 1
+    reader_stats.lines += n_lines
+    reader_stats.time += time.perf_counter() - start_time
+    return values
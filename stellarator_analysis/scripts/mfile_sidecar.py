@@ -0,0 +1,228 @@
+'''
+Binary sidecar written next to every MFILE.DAT
+
+<prefix>.MFILE.bin holds the scalar values of the MFILE in binary form:
+
+    b'MFSIDE', uint16 version, uint32 header length, JSON header
+    padding to a multiple of 64 bytes
+    float64[n_float]   float values
+    int64[n_int]       integer values
+    float64[...]       profile series, one contiguous block per family
+
+The JSON header holds the name -> index tables of both arrays, the string
+values and {family: [offset, length]} of the profile series, e.g.
+pres_plasma_thermal_total_profile0..500 is stored as the family
+'pres_plasma_thermal_total_profile'. The arrays are opened with np.memmap,
+so only the pages that are used are read from disk.
+
+A sidecar is used instead of the MFILE when it is at least as new as the
+MFILE and was written from a file of the same size.
+'''
+from stellarator_analysis.scripts import mfile_reader
+import numpy as np
+import json
+import os
+import re
+import struct
+
+SIDECAR_VERSION = 1
+MAGIC = b'MFSIDE'
+ALIGN = 64
+PROFILE_PATTERN = re.compile(r'^(\w+_profile)(\d+)$')
+
+
+def sidecar_path(mfile_path):
+    """
+    Path of the sidecar of an MFILE, squid.MFILE.DAT -> squid.MFILE.bin.
+    """
+    root, _ = os.path.splitext(mfile_path)
+    return root + '.bin'
+
+
+def profile_families(values):
+    """
+    {family: [name_0, ..., name_n-1]} of numeric series name_0, name_1, ...
+    without gaps.
+    """
+    indices = {}
+    for name, value in values.items():
+        match = PROFILE_PATTERN.match(name)
+        if match and isinstance(value, (int, float)):
+            indices.setdefault(match.group(1), set()).add(int(match.group(2)))
+    families = {}
+    for family, found in indices.items():
+        if found == set(range(len(found))):
+            families[family] = [f'{family}{i}' for i in range(len(found))]
+    return families
+
+
+def write_sidecar(mfile_path):
+    """
+    Write the sidecar of an MFILE and return its path.
+    """
+    values = mfile_reader.read_values(mfile_path)
+    families = profile_families(values)
+    in_profile = {name for names in families.values() for name in names}
+
+    floats, ints, strings = {}, {}, {}
+    for name, value in values.items():
+        if name in in_profile:
+            continue
+        if isinstance(value, str):
+            strings[name] = value
+        elif isinstance(value, int) and abs(value) < 2 ** 63:
+            ints[name] = value
+        else:
+            floats[name] = float(value)
+
+    profiles = {}
+    offset = 0
+    for family, names in sorted(families.items()):
+        profiles[family] = [offset, len(names)]
+        offset += len(names)
+    profile_data = np.array([values[name] for family in sorted(families) for name in families[family]],
+                            dtype='<f8')
+
+    header = json.dumps({'version': SIDECAR_VERSION,
+                         'mfile_size': os.stat(mfile_path).st_size,
+                         'floats': list(floats),
+                         'ints': list(ints),
+                         'strings': strings,
+                         'profiles': profiles}).encode()
+    start = len(MAGIC) + struct.calcsize('<HI') + len(header)
+    padding = -start % ALIGN
+
+    path = sidecar_path(mfile_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<HI', SIDECAR_VERSION, len(header)) + header + b'\0' * padding)
+        f.write(np.array(list(floats.values()), dtype='<f8').tobytes())
+        f.write(np.array(list(ints.values()), dtype='<i8').tobytes())
+        f.write(profile_data.tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+def is_fresh(mfile_path):
+    """
+    True if the MFILE has a sidecar of the current version which is at least
+    as new as the MFILE and was written from a file of the same size.
+    """
+    path = sidecar_path(mfile_path)
+    if not os.path.isfile(path):
+        return False
+    mfile_stat = os.stat(mfile_path)
+    if os.stat(path).st_mtime_ns < mfile_stat.st_mtime_ns:
+        return False
+    try:
+        header = Sidecar.read_header(path)[0]
+    except ValueError:
+        return False
+    return header['version'] == SIDECAR_VERSION and header['mfile_size'] == mfile_stat.st_size
+
+
+class Sidecar:
+    """
+    Memory mapped read access to a sidecar file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header, data_offset = self.read_header(path)
+        self.float_index = {name: i for i, name in enumerate(self.header['floats'])}
+        self.int_index = {name: i for i, name in enumerate(self.header['ints'])}
+        self.strings = self.header['strings']
+        self.profiles = self.header['profiles']
+        n_profile = sum(length for _, length in self.profiles.values())
+
+        self.floats = self._map(data_offset, '<f8', len(self.float_index))
+        data_offset += 8 * len(self.float_index)
+        self.ints = self._map(data_offset, '<i8', len(self.int_index))
+        data_offset += 8 * len(self.int_index)
+        self.profile_data = self._map(data_offset, '<f8', n_profile)
+
+    @staticmethod
+    def read_header(path):
+        """
+        (header dict, offset of the first array) of a sidecar file.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not an MFILE sidecar')
+            version, length = struct.unpack('<HI', f.read(struct.calcsize('<HI')))
+            header = json.loads(f.read(length))
+        start = len(MAGIC) + struct.calcsize('<HI') + length
+        return header, start + (-start % ALIGN)
+
+    def _map(self, offset, dtype, count):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def _find(self, name):
+        if name in self.float_index:
+            return float(self.floats[self.float_index[name]])
+        if name in self.int_index:
+            return int(self.ints[self.int_index[name]])
+        if name in self.strings:
+            return self.strings[name]
+        match = PROFILE_PATTERN.match(name)
+        if match and match.group(1) in self.profiles:
+            offset, length = self.profiles[match.group(1)]
+            i = int(match.group(2))
+            if i < length:
+                return float(self.profile_data[offset + i])
+        return None
+
+    def profile(self, family):
+        """
+        Profile series of a family as a read-only array.
+        """
+        offset, length = self.profiles[family]
+        return self.profile_data[offset:offset + length]
+
+    def values(self, names=None):
+        """
+        {name: value} of the requested names, of all values if names is None.
+        Profile series are expanded to their individual names.
+        """
+        if names is not None:
+            values = {}
+            for name in names:
+                value = self._find(name)
+                if value is not None:
+                    values[name] = value
+            return values
+
+        values = dict(zip(self.float_index, self.floats.tolist()))
+        values.update(zip(self.int_index, self.ints.tolist()))
+        values.update(self.strings)
+        for family in self.profiles:
+            values.update((f'{family}{i}', value) for i, value in enumerate(self.profile(family).tolist()))
+        return values
+
+
+def read_values(mfile_path, names=None):
+    """
+    mfile_reader.read_values, served from the sidecar if it is fresh.
+    """
+    if is_fresh(mfile_path):
+        return Sidecar(sidecar_path(mfile_path)).values(names)
+    return mfile_reader.read_values(mfile_path, names)
+
+
+def update_sidecars(results_dir, prefix='squid'):
+    """
+    Write the missing or stale sidecars of all cases in results_dir and
+    return the number written.
+    """
+    written = 0
+    for case in sorted(os.listdir(results_dir)):
+        mfile_path = os.path.join(results_dir, case, prefix + '.MFILE.DAT')
+        if os.path.isfile(mfile_path) and not is_fresh(mfile_path):
+            write_sidecar(mfile_path)
+            written += 1
+    return written
@@ -0,0 +1,173 @@
+'''
+Incremental regeneration of figures driven by their recorded dependencies
+
+While a plot function runs, every results column it reads (through
+track) and every file it writes (through saved) is recorded. The state,
+a digest of the columns and a hash of the plotting module, is kept in a
+JSON file between runs; a figure is only rendered again when one of them
+changed or one of its outputs is missing.
+
+render_all fans the out of date figures of several folders out to a
+process pool. Plot functions build their figures with the object-oriented
+API, so workers never touch pyplot or an interactive backend.
+'''
+from stellarator_analysis.scripts import results_store
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import inspect
+import json
+import os
+
+_active = None
+
+
+def track(workdir, name):
+    """
+    Record that the figure being rendered reads column name of the scan in workdir.
+    """
+    if _active is not None:
+        _active['deps'].add((os.path.realpath(workdir), name))
+
+
+def saved(path):
+    """
+    Record that the figure being rendered wrote path.
+    """
+    if _active is not None:
+        _active['outputs'].add(os.path.realpath(path))
+
+
+def run(plot_fn, *args, **kwargs):
+    """
+    Call plot_fn(*args, **kwargs) and return the (workdir, name) columns it
+    read and the files it wrote.
+    """
+    global _active
+    _active = {'deps': set(), 'outputs': set()}
+    try:
+        plot_fn(*args, **kwargs)
+        return sorted(_active['deps']), sorted(_active['outputs'])
+    finally:
+        _active = None
+
+
+def code_hash(plot_fn):
+    """
+    Hash of the source of the module that defines plot_fn.
+    """
+    module = inspect.getmodule(plot_fn)
+    source = inspect.getsource(module) if module is not None else plot_fn.__code__.co_code.hex()
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class PlotGraph:
+    """
+    Figures of one scan folder with the dependencies recorded at their last render.
+    """
+
+    def __init__(self, state_path, prefix='squid'):
+        self.state_path = state_path
+        self.base = os.path.dirname(os.path.realpath(state_path))
+        self.prefix = prefix
+        self.state = {}
+        self.rendered = []
+        self.skipped = []
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+    def digest(self, deps):
+        """
+        Digest of the case list, ifail and every column listed in deps.
+        """
+        digest = hashlib.sha256()
+        for workdir in sorted({workdir for workdir, _ in deps}):
+            table = results_store.load(workdir, self.prefix)
+            digest.update(workdir.encode())
+            digest.update(table.cases.tobytes())
+            digest.update(table.ifail.tobytes())
+            for name in sorted(name for dep_dir, name in deps if dep_dir == workdir):
+                digest.update(name.encode())
+                digest.update(table.column(name).tobytes())
+        return digest.hexdigest()
+
+    def relative(self, path):
+        return os.path.relpath(path, self.base)
+
+    def absolute(self, path):
+        return os.path.normpath(os.path.join(self.base, path))
+
+    def up_to_date(self, key, code):
+        entry = self.state.get(key)
+        if entry is None or entry['code'] != code or not entry['outputs']:
+            return False
+        if not all(os.path.isfile(self.absolute(path)) for path in entry['outputs']):
+            return False
+        deps = [(self.absolute(workdir), name) for workdir, name in entry['deps']]
+        return entry['digest'] == self.digest(deps)
+
+    def key(self, plot_fn, args, kwargs):
+        call = [self.relative(arg) if isinstance(arg, str) and os.path.isabs(arg) else arg for arg in args]
+        return f'{plot_fn.__name__}{tuple(call)!r}{sorted(kwargs.items())!r}'
+
+    def record(self, key, code, deps, outputs):
+        """
+        Store the dependencies and outputs of a finished render.
+        """
+        self.state[key] = {'code': code,
+                           'deps': [[self.relative(workdir), name] for workdir, name in deps],
+                           'outputs': sorted(self.relative(path) for path in outputs),
+                           'digest': self.digest(deps)}
+
+    def render(self, plot_fn, *args, **kwargs):
+        """
+        Call plot_fn(*args, **kwargs) unless its last render is still up to date.
+        Returns True if the figure was rendered.
+        """
+        key = self.key(plot_fn, args, kwargs)
+        code = code_hash(plot_fn)
+        if self.up_to_date(key, code):
+            self.skipped.append(plot_fn.__name__)
+            return False
+
+        self.record(key, code, *run(plot_fn, *args, **kwargs))
+        self.rendered.append(plot_fn.__name__)
+        return True
+
+    def save(self):
+        with open(self.state_path, 'w') as f:
+            json.dump(self.state, f, indent=4)
+
+    def report(self):
+        print(f'{len(self.rendered)} figures rendered, {len(self.skipped)} up to date')
+
+
+def render_all(jobs, max_workers=None):
+    """
+    Render (graph, plot_fn, args, kwargs) jobs of any number of folders in
+    parallel, skipping the ones that are up to date. max_workers defaults
+    to the number of CPUs. Results stores must be collected beforehand so
+    that workers only read them; the stores open in this process are
+    closed before the workers are started.
+    """
+    pending = []
+    for graph, plot_fn, args, kwargs in jobs:
+        key = graph.key(plot_fn, args, kwargs)
+        code = code_hash(plot_fn)
+        if graph.up_to_date(key, code):
+            graph.skipped.append(plot_fn.__name__)
+        else:
+            pending.append((graph, plot_fn, args, kwargs, key, code))
+    if not pending:
+        return
+
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(pending)))
+    # Forked workers must not inherit open stores: they would share file offsets
+    results_store.close_tables()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, plot_fn, *args, **kwargs): (graph, plot_fn, key, code)
+                   for graph, plot_fn, args, kwargs, key, code in pending}
+        for future in as_completed(futures):
+            graph, plot_fn, key, code = futures[future]
+            graph.record(key, code, *future.result())
+            graph.rendered.append(plot_fn.__name__)
@@ -0,0 +1,127 @@
+'''
+Worker side of run_cases.WorkerPool: run many cases in one interpreter
+
+Running a case through its run_me.py starts a new interpreter which imports
+process.main again, which takes seconds and dominates short runs. The
+worker processes of a WorkerPool import PROCESS once in initialise and then
+run one SingleRun per case with run_case, in the case directory and with
+stdout and stderr going to its run.log, as run_me.py does, and write its
+telemetry.
+
+Between runs the worker resets what a run may leave behind: the module
+variables of PROCESS (process.init.init_all_module_vars, which SingleRun
+also calls), the working directory, sys.argv, the logging handlers, warning
+filters and open matplotlib figures.
+'''
+from stellarator_analysis.scripts import telemetry
+import traceback
+import logging
+import warnings
+import signal
+import time
+import sys
+import os
+
+_process_main = None
+
+
+class CaseTimeout(Exception):
+    pass
+
+
+def initialise():
+    """
+    Import PROCESS once per worker process.
+    """
+    global _process_main
+    from process import main
+    _process_main = main
+
+
+def reset_state():
+    """
+    Reset the module variables of PROCESS to their defaults.
+    """
+    try:
+        from process import init
+    except ImportError:
+        return
+    if hasattr(init, 'init_all_module_vars'):
+        init.init_all_module_vars()
+
+
+def _on_timeout(signum, frame):
+    raise CaseTimeout()
+
+
+def run_case(case_dir, prefix='squid', timeout=None):
+    """
+    Run one case in this worker and return (returncode, elapsed). The
+    returncode is 0 if the run finished, 1 if it raised and None if it
+    was stopped after timeout seconds.
+    """
+    if _process_main is None:
+        initialise()
+    cwd = os.getcwd()
+    argv = list(sys.argv)
+    handlers = list(logging.getLogger().handlers)
+    filters = list(warnings.filters)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    timer = telemetry.PhaseTimer()
+    telemetry.reset_peak_rss()
+    cpu_start = telemetry.cpu_time()
+    start = time.perf_counter()
+    with open(os.path.join(case_dir, 'run.log'), 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        if timeout is not None:
+            signal.signal(signal.SIGALRM, _on_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            os.chdir(case_dir)
+            sys.argv = ['run_me.py', '-n', prefix]
+            reset_state()
+            telemetry.run_single(_process_main.SingleRun, os.path.join(case_dir, prefix + '.IN.DAT'), timer)
+            returncode = 0
+        except CaseTimeout:
+            print(f'Run stopped after {timeout:.0f} s', flush=True)
+            returncode = None
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            if timeout is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+            os.chdir(cwd)
+            sys.argv = argv
+            _restore_logging(handlers)
+            warnings.filters[:] = filters
+            _close_figures()
+    elapsed = time.perf_counter() - start
+    telemetry.write(case_dir, prefix, {'wall_time': elapsed, 'cpu_time': telemetry.cpu_time() - cpu_start,
+                                       'peak_rss_mb': telemetry.peak_rss_mb(), 'phases': timer.phases,
+                                       'mode': 'worker'})
+    return returncode, elapsed
+
+
+def _restore_logging(handlers):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if handler not in handlers:
+            root.removeHandler(handler)
+            handler.close()
+
+
+def _close_figures():
+    pyplot = sys.modules.get('matplotlib.pyplot')
+    if pyplot is not None:
+        pyplot.close('all')
@@ -0,0 +1,135 @@
+'''
+Vectorised queries over the collected results of one or many scans
+
+    query = results_query.open_studies('stellarator_analysis/coil_aspect_scan')
+    selection = (query.select('coe', 'rmajor')
+                 .where('ifail', '==', 1)
+                 .where('ineq_con024', '<', 0.01))
+    for study, arrays in selection.group_by_study().items():
+        print(study, arrays['_scan_value'], arrays['coe'])
+
+Every query works on the columnar stores of results_store, so no MFILE is
+opened again. Selections return NumPy arrays; every result also holds the
+'_study', '_case' and '_scan_value' of the selected rows.
+'''
+from stellarator_analysis.scripts import results_store
+import numpy as np
+import os
+
+OPERATORS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+             '==': np.equal, '!=': np.not_equal}
+
+
+def open_studies(workdir, main_name='results', prefix='squid', exclude=()):
+    """
+    Query over every study folder in workdir whose main_name directory holds
+    finished cases, e.g. HTS_larger_coil and HTS_new_configuration.
+    """
+    tables = {}
+    for study in sorted(os.listdir(workdir)):
+        results_dir = os.path.join(workdir, study, main_name)
+        if study in exclude or not os.path.isdir(results_dir):
+            continue
+        if results_store.list_cases(results_dir, prefix):
+            tables[study] = results_store.load(results_dir, prefix)
+    return Query(tables)
+
+
+def open_scan(results_dir, prefix='squid', study=None):
+    """
+    Query over a single scan results directory.
+    """
+    if study is None:
+        study = os.path.basename(os.path.dirname(os.path.realpath(results_dir)))
+    return Query({study: results_store.load(results_dir, prefix)})
+
+
+def concatenate(name, arrays):
+    """
+    Rows of {study: array} concatenated in study order. Profile matrices of
+    different widths are padded with NaN to the widest; a study without the
+    profile gives rows of NaN.
+    """
+    if all(array.ndim == 1 for array in arrays.values()):
+        return np.concatenate(list(arrays.values()))
+    width = max(array.shape[1] for array in arrays.values() if array.ndim == 2)
+    padded = []
+    for study, array in arrays.items():
+        if array.ndim == 1 and not np.isnan(array).all():
+            profiles = [other for other, matrix in arrays.items() if matrix.ndim == 2]
+            raise ValueError(f'{name} is a profile in {", ".join(profiles)} but a scalar in {study}')
+        block = np.full((len(array), width), np.nan)
+        if array.ndim == 2:
+            block[:, :array.shape[1]] = array
+        padded.append(block)
+    return np.concatenate(padded)
+
+
+class Query:
+    """
+    Immutable selection of variables and row conditions over {study: ResultsTable}.
+    select, where and converged return a new Query.
+    """
+
+    def __init__(self, tables, names=(), conditions=()):
+        self.tables = tables
+        self.names = tuple(names)
+        self.conditions = tuple(conditions)
+
+    def select(self, *names):
+        return Query(self.tables, self.names + names, self.conditions)
+
+    def where(self, name, op, value):
+        """
+        Keep rows where column name compares to value with op, one of
+        '<', '<=', '>', '>=', '==', '!='. NaN never matches.
+        """
+        if op not in OPERATORS:
+            raise ValueError(f'Unknown operator {op}, expected one of {", ".join(OPERATORS)}')
+        return Query(self.tables, self.names, self.conditions + ((name, op, value),))
+
+    def converged(self):
+        return self.where('ifail', '==', 1)
+
+    def mask(self, table):
+        """
+        Boolean row mask of the conditions for one table.
+        """
+        mask = np.ones(len(table), dtype=bool)
+        for name, op, value in self.conditions:
+            column = table.ifail if name == 'ifail' else table.column(name)
+            with np.errstate(invalid='ignore'):
+                mask &= OPERATORS[op](column, value)
+        return mask
+
+    def group_by_study(self):
+        """
+        {study: {name: array}} of the selected rows of every study.
+        """
+        groups = {}
+        for study, table in self.tables.items():
+            mask = self.mask(table)
+            arrays = {'_study': np.full(int(mask.sum()), study),
+                      '_case': table.cases[mask],
+                      '_scan_value': table.scan_value[mask]}
+            for name in self.names:
+                arrays[name] = table.profile(name)[mask] if name in table.profiles else table.column(name)[mask]
+            groups[study] = arrays
+        return groups
+
+    def arrays(self):
+        """
+        {name: array} of the selected rows of all studies concatenated.
+        Profiles are padded with NaN to the widest profile of the studies.
+        """
+        groups = self.group_by_study()
+        if not groups:
+            return {name: np.zeros(0) for name in ('_study', '_case', '_scan_value') + self.names}
+        return {name: concatenate(name, {study: group[name] for study, group in groups.items()})
+                for name in next(iter(groups.values()))}
+
+    def count(self):
+        """
+        {study: number of selected rows}.
+        """
+        return {study: int(self.mask(table).sum()) for study, table in self.tables.items()}
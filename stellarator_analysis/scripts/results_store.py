@@ -0,0 +1,419 @@
+'''
+Columnar store of scan results collected from the results/<short>_<value> directories
+
+The whole scan is written into one uncompressed .npz file with a row per case
+and a column per MFILE variable, so readers can load only the columns they need
+instead of parsing every MFILE.DAT again. Indexed profile families such as
+pres_plasma_thermal_total_profile0..500 are stored as one (cases x points)
+array per family instead of a column per point. The runtime telemetry of
+every case (see telemetry) is stored as telemetry_<field> columns.
+'''
+from stellarator_analysis.scripts.mfile_sidecar import PROFILE_PATTERN, profile_families, read_values
+from stellarator_analysis.scripts.lru_cache import LRUCache
+from stellarator_analysis.scripts import telemetry
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import hashlib
+import time
+import os
+
+STORE_VERSION = 4
+
+# Reserved column names, all other columns are MFILE variables or profile families
+META_COLUMNS = ['_version', '_case', '_scan_value', '_ifail', '_mfile_sha256', '_mfile_mtime_ns', '_mfile_size',
+                '_indat_sha256', '_profiles', '_telemetry_mtime_ns']
+
+# Bounds of the session caches: bytes of loaded columns per table and number of open tables
+COLUMN_CACHE_BYTES = 256 * 2 ** 20
+MAX_OPEN_TABLES = 64
+
+# Collections with fewer cases to parse are read in the calling process
+PARALLEL_MIN_CASES = 16
+
+
+def store_path(results_dir, prefix='squid'):
+    """
+    Path of the columnar store for a scan results directory.
+    """
+    return os.path.join(results_dir, prefix + '.results.npz')
+
+
+def file_hash(filename):
+    """
+    SHA-256 of a file, empty string if the file does not exist.
+    """
+    if not os.path.isfile(filename):
+        return ''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_cases(results_dir, prefix='squid'):
+    """
+    Sorted list of case directories in results_dir which contain an MFILE.
+    """
+    cases = []
+    for case in os.listdir(results_dir):
+        if os.path.isfile(os.path.join(results_dir, case, prefix + '.MFILE.DAT')):
+            cases.append(case)
+    return sorted(cases)
+
+
+def scan_value_from_case(case):
+    """
+    Scan value encoded in a case directory name, e.g. 0.8 for 'Ac_0.80'.
+    """
+    try:
+        return float(case.rsplit('_', 1)[-1])
+    except ValueError:
+        return np.nan
+
+
+def read_case(results_dir, case, prefix='squid'):
+    """
+    Read the final scalar values of one case as a {name: value} dict, from
+    its binary sidecar if that is up to date. Variables with more than one
+    scan point are skipped.
+    """
+    return read_values(os.path.join(results_dir, case, prefix + '.MFILE.DAT'))
+
+
+def split_profiles(values):
+    """
+    Remove the indexed profile families from the {name: value} dict of a
+    case and return them as {family: ndarray}.
+    """
+    profiles = {}
+    for family, names in profile_families(values).items():
+        profiles[family] = np.array([values.pop(name) for name in names], dtype=np.float64)
+    return profiles
+
+
+def case_profiles(results_dir, case, prefix='squid'):
+    """
+    {family: ndarray} of all profile families of one case.
+    """
+    return split_profiles(read_case(results_dir, case, prefix))
+
+
+def ingest_case(mfile_path):
+    """
+    Read one MFILE for parallel collection. Returns compact, cheaply
+    pickled parts instead of a dict of Python floats: the numeric names
+    joined by newlines, their float64 values, {name: string value},
+    {family: profile} and the SHA-256 of the file. The telemetry of the
+    case is read with its MFILE.
+    """
+    values = read_values(mfile_path)
+    profiles = split_profiles(values)
+    case_dir, filename = os.path.split(mfile_path)
+    values.update(telemetry.flatten(telemetry.read(case_dir, filename[:-len('.MFILE.DAT')])))
+    strings = {name: value for name, value in values.items() if isinstance(value, str)}
+    numeric = [name for name in values if name not in strings]
+    numbers = np.array([values[name] for name in numeric], dtype=np.float64)
+    return '\n'.join(numeric), numbers, strings, profiles, file_hash(mfile_path)
+
+
+def read_cases(mfile_paths, max_workers=None):
+    """
+    [(values, profiles, sha256)] of the MFILEs, read on a process pool of
+    max_workers (default: all CPUs) if there are at least PARALLEL_MIN_CASES.
+    """
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(mfile_paths)))
+    if workers == 1 or len(mfile_paths) < PARALLEL_MIN_CASES:
+        parts = [ingest_case(mfile_path) for mfile_path in mfile_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(ingest_case, mfile_paths, chunksize=max(1, len(mfile_paths) // (4 * workers))))
+
+    cases = []
+    for names, numbers, strings, profiles, sha256 in parts:
+        values = dict(zip(names.split('\n'), numbers.tolist())) if names else {}
+        values.update(strings)
+        cases.append((values, profiles, sha256))
+    return cases
+
+
+def merge_columns(n_cases, rows, old=None, reused=None):
+    """
+    Build {name: ndarray} columns for n_cases cases from freshly parsed
+    {row: {name: value}} dicts and rows reused from an old store
+    ({row: old row}). Numeric columns are float64 with NaN for missing
+    values, columns with any string value are stored as unicode arrays.
+    """
+    reused = reused or {}
+    new_rows = sorted(rows)
+    names = set().union(*rows.values()) if rows else set()
+    if old is not None and reused:
+        names |= {name for name in old.files if name not in META_COLUMNS and name not in old['_profiles']}
+    reused_new = np.array(sorted(reused), dtype=int)
+    reused_old = np.array([reused[row] for row in sorted(reused)], dtype=int)
+
+    columns = {}
+    for name in sorted(names):
+        values = [rows[row].get(name) for row in new_rows]
+        old_column = old[name] if old is not None and len(reused_new) and name in old.files else None
+        is_string = old_column is not None and old_column.dtype.kind == 'U'
+        if is_string or any(isinstance(value, str) for value in values):
+            column = np.full(n_cases, '', dtype=object)
+            if old_column is not None:
+                column[reused_new] = old_column[reused_old].astype(str)
+            column[new_rows] = ['' if value is None else str(value) for value in values]
+            columns[name] = column.astype(str)
+        else:
+            column = np.full(n_cases, np.nan)
+            if old_column is not None:
+                column[reused_new] = old_column[reused_old]
+            column[new_rows] = [np.nan if value is None else value for value in values]
+            columns[name] = column
+    return columns
+
+
+def merge_profiles(n_cases, rows, old=None, reused=None):
+    """
+    Build {family: (n_cases x points) array} from freshly parsed
+    {row: {family: ndarray}} dicts and rows reused from an old store.
+    Profiles shorter than the longest one of their family are NaN padded.
+    """
+    reused = reused or {}
+    reused_new = np.array(sorted(reused), dtype=int)
+    reused_old = np.array([reused[row] for row in sorted(reused)], dtype=int)
+    old_families = set(old['_profiles']) if old is not None and reused else set()
+    families = set().union(*rows.values()) if rows else set()
+
+    matrices = {}
+    for family in sorted(families | old_families):
+        old_matrix = old[family] if family in old_families else None
+        lengths = [len(profiles[family]) for profiles in rows.values() if family in profiles]
+        if old_matrix is not None:
+            lengths.append(old_matrix.shape[1])
+        matrix = np.full((n_cases, max(lengths)), np.nan)
+        if old_matrix is not None:
+            matrix[reused_new, :old_matrix.shape[1]] = old_matrix[reused_old]
+        for row, profiles in rows.items():
+            if family in profiles:
+                matrix[row, :len(profiles[family])] = profiles[family]
+        matrices[family] = matrix
+    return matrices
+
+
+def telemetry_mtime_ns(results_dir, case, prefix='squid'):
+    """
+    Modification time of the telemetry of a case, 0 if it has none.
+    """
+    try:
+        return os.stat(telemetry.telemetry_path(os.path.join(results_dir, case), prefix)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def reusable_rows(path, cases, stats, telemetry_mtimes):
+    """
+    Open an existing store and return it with {row: old row} for every case
+    whose MFILE has the same modification time and size, and whose
+    telemetry the same modification time, as when it was collected.
+    Returns (None, {}) if there is no usable store.
+    """
+    if not os.path.isfile(path):
+        return None, {}
+    old = np.load(path)
+    if '_version' not in old.files or int(old['_version']) != STORE_VERSION:
+        old.close()
+        return None, {}
+    old_rows = {case: row for row, case in enumerate(old['_case'])}
+    mtimes, sizes, old_telemetry_mtimes = old['_mfile_mtime_ns'], old['_mfile_size'], old['_telemetry_mtime_ns']
+    reused = {}
+    for row, (case, stat, telemetry_mtime) in enumerate(zip(cases, stats, telemetry_mtimes)):
+        old_row = old_rows.get(case)
+        if (old_row is not None and mtimes[old_row] == stat.st_mtime_ns and sizes[old_row] == stat.st_size
+                and old_telemetry_mtimes[old_row] == telemetry_mtime):
+            reused[row] = old_row
+    return old, reused
+
+
+def collect(results_dir, prefix='squid', verbose=False, incremental=True, max_workers=None):
+    """
+    Collect all cases of a scan into the columnar store and return its path.
+    With incremental, cases whose MFILE did not change since the last
+    collection are copied from the existing store instead of being parsed.
+    Large collections are parsed on max_workers processes.
+    """
+    start = time.perf_counter()
+    path = store_path(results_dir, prefix)
+    cases = list_cases(results_dir, prefix)
+    mfiles = [os.path.join(results_dir, case, prefix + '.MFILE.DAT') for case in cases]
+    stats = [os.stat(mfile) for mfile in mfiles]
+    telemetry_mtimes = [telemetry_mtime_ns(results_dir, case, prefix) for case in cases]
+
+    old, reused = reusable_rows(path, cases, stats, telemetry_mtimes) if incremental else (None, {})
+    parse = [row for row in range(len(cases)) if row not in reused]
+    parsed = dict(zip(parse, read_cases([mfiles[row] for row in parse], max_workers)))
+    rows = {row: values for row, (values, _, _) in parsed.items()}
+    profile_rows = {row: profiles for row, (_, profiles, _) in parsed.items()}
+    columns = merge_columns(len(cases), rows, old, reused)
+    profiles = merge_profiles(len(cases), profile_rows, old, reused)
+
+    old_sha256 = old['_mfile_sha256'] if old is not None else None
+    mfile_sha256 = [old_sha256[reused[row]] if row in reused else parsed[row][2] for row in range(len(cases))]
+    if old is not None:
+        old.close()
+
+    ifail = columns.get('ifail', np.full(len(cases), np.nan))
+    columns['_version'] = np.array(STORE_VERSION)
+    columns['_case'] = np.array(cases, dtype=str)
+    columns['_scan_value'] = np.array([scan_value_from_case(case) for case in cases], dtype=np.float64)
+    columns['_ifail'] = np.where(np.isfinite(ifail), ifail, -1).astype(np.int64)
+    columns['_mfile_sha256'] = np.array(mfile_sha256, dtype=str)
+    columns['_mfile_mtime_ns'] = np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+    columns['_mfile_size'] = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    columns['_telemetry_mtime_ns'] = np.array(telemetry_mtimes, dtype=np.int64)
+    columns['_indat_sha256'] = np.array(
+        [file_hash(os.path.join(results_dir, case, prefix + '.IN.DAT')) for case in cases], dtype=str)
+    columns['_profiles'] = np.array(sorted(profiles), dtype=str)
+    columns.update(profiles)
+
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f'Collected {len(cases)} cases ({len(rows)} parsed, {len(reused)} unchanged) '
+              f'with {len(columns) - len(META_COLUMNS) - len(profiles)} variables and {len(profiles)} profiles '
+              f'into {path} in {elapsed:.2f} s ({len(rows) / elapsed:.0f} parsed cases/s)')
+    return path
+
+
+def is_stale(results_dir, prefix='squid'):
+    """
+    True if the store is missing, has an old version, or if any MFILE was
+    added, removed or modified, or any telemetry written, after the store
+    was written.
+    """
+    path = store_path(results_dir, prefix)
+    if not os.path.isfile(path):
+        return True
+    store_mtime = os.stat(path).st_mtime_ns
+    cases = list_cases(results_dir, prefix)
+    for case in cases:
+        if os.stat(os.path.join(results_dir, case, prefix + '.MFILE.DAT')).st_mtime_ns > store_mtime:
+            return True
+        if telemetry_mtime_ns(results_dir, case, prefix) > store_mtime:
+            return True
+    with np.load(path) as store:
+        return int(store['_version']) != STORE_VERSION or list(store['_case']) != cases
+
+
+class ResultsTable:
+    """
+    Read access to a columnar store.
+    The case metadata is read when the table is opened, columns are read
+    from disk on first access and kept in an LRU cache of at most
+    max_bytes, so comparisons of many large scans stay within memory.
+    A closed table opens its file again on the next column read.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self._npz = np.load(path)
+        self._columns = LRUCache(COLUMN_CACHE_BYTES if max_bytes is None else max_bytes,
+                                 sizeof=lambda column: column.nbytes, name=path)
+        self.files = set(self._npz.files)
+        self.profiles = self._npz['_profiles'].tolist()
+        self.names = [name for name in self._npz.files if name not in META_COLUMNS and name not in self.profiles]
+        self.cases = self._npz['_case']
+        self.scan_value = self._npz['_scan_value']
+        self.ifail = self._npz['_ifail']
+
+    def __len__(self):
+        return len(self.cases)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __getitem__(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            if self._npz is None:
+                self._npz = np.load(self.path)
+            column = self._npz[name]
+            self._columns.put(name, column)
+        return column
+
+    def cache_stats(self):
+        """
+        Hit, miss and eviction counters of the column cache.
+        """
+        return self._columns.stats()
+
+    def column(self, name):
+        """
+        Column for name, NaN filled if the variable is not in the store.
+        Single points of a profile, e.g. pres_plasma_fuel_profile44, are
+        taken from the profile matrix.
+        """
+        if name in self:
+            return self[name]
+        match = PROFILE_PATTERN.match(name)
+        if match and match.group(1) in self.profiles:
+            matrix = self.profile(match.group(1))
+            if int(match.group(2)) < matrix.shape[1]:
+                return matrix[:, int(match.group(2))]
+        return np.full(len(self), np.nan)
+
+    def profile(self, family):
+        """
+        (cases x points) matrix of a profile family, e.g.
+        'pres_plasma_thermal_total_profile'.
+        """
+        return self[family]
+
+    def close(self):
+        if self._npz is not None:
+            self._npz.close()
+            self._npz = None
+
+
+_tables = LRUCache(MAX_OPEN_TABLES, on_evict=lambda path, entry: entry[1].close(), name='Results tables')
+
+
+def load(results_dir, prefix='squid', rebuild=True, verbose=False):
+    """
+    Return the ResultsTable of a scan, (re)collecting it first if it is stale.
+    Tables are kept open in an LRU cache of MAX_OPEN_TABLES scans.
+    """
+    if rebuild and is_stale(results_dir, prefix):
+        collect(results_dir, prefix, verbose=verbose)
+
+    path = store_path(results_dir, prefix)
+    mtime = os.stat(path).st_mtime_ns
+    entry = _tables.get(path)
+    if entry is None or entry[0] != mtime:
+        if entry is not None:
+            _tables.discard(path)
+            entry[1].close()
+        entry = (mtime, ResultsTable(path))
+        _tables.put(path, entry)
+    return entry[1]
+
+
+def close_tables():
+    """
+    Close the files of all cached tables, which stay cached and reopen on
+    their next read. Call before forking workers: a forked worker shares the
+    file offsets of the files open in its parent.
+    """
+    for _, table in _tables.values():
+        table.close()
+
+
+def cache_report():
+    """
+    Print the counters of the table cache and of the column cache of every open table.
+    """
+    _tables.report()
+    for _, table in _tables.values():
+        table._columns.report()
@@ -0,0 +1,79 @@
+'''
+Retry ladder for cases which did not converge (ifail != 1)
+
+Every strategy modifies the original IN.DAT of a failed case before it is
+queued again. Strategies are tried in order until one converges or the
+wall-clock budget of the case is used up.
+'''
+from stellarator_analysis.scripts import warm_start
+from dataclasses import dataclass, field
+import random
+
+
+@dataclass
+class RetryContext:
+    """
+    Information a retry strategy can use to modify a failed case.
+    """
+    case: str
+    indat_path: str
+    attempt: int
+    start_point: dict = field(default_factory=dict)
+    neighbour_mfile: str = None
+    exclude: tuple = ()
+
+
+@dataclass
+class Strategy:
+    """
+    Named modification of the input of a failed case.
+    apply returns False if the strategy cannot be used for this case.
+    """
+    name: str
+    apply: callable
+
+
+def neighbour_warm_start(context):
+    """
+    Start from the solution of the nearest converged case.
+    """
+    if context.neighbour_mfile is None:
+        return False
+    return warm_start.warm_start(context.indat_path, context.neighbour_mfile, context.exclude) is not None
+
+
+def perturbed_start(scale):
+    """
+    Strategy which multiplies every initial iteration variable by a random
+    factor 1 + N(0, scale), clipped to the bounds. The perturbation is
+    reproducible for a given case and attempt.
+    """
+    def apply(context):
+        if not context.start_point:
+            return False
+        rng = random.Random(f'{context.case}/{context.attempt}')
+        values = {name: min(max(value * (1 + rng.gauss(0, scale)), lower), upper)
+                  for name, (value, lower, upper) in context.start_point.items()
+                  if name not in context.exclude}
+        warm_start.set_parameters(context.indat_path, values)
+        return True
+    return apply
+
+
+def finite_difference_step(epsfcn):
+    """
+    Strategy which changes the finite difference step of the solver.
+    """
+    def apply(context):
+        warm_start.set_parameters(context.indat_path, {'epsfcn': epsfcn})
+        return True
+    return apply
+
+
+DEFAULT_LADDER = [
+    Strategy('neighbour warm start', neighbour_warm_start),
+    Strategy('perturbed start (5%)', perturbed_start(0.05)),
+    Strategy('epsfcn = 1e-4', finite_difference_step(1e-4)),
+    Strategy('perturbed start (15%)', perturbed_start(0.15)),
+    Strategy('epsfcn = 1e-2', finite_difference_step(1e-2)),
+]
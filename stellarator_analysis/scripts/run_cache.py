@@ -0,0 +1,120 @@
+'''
+Content-addressed cache of finished PROCESS runs
+
+A case is keyed by the hash of the content of its IN.DAT (see
+InDatModel.semantic_key, layout and comments do not matter) and of its
+stella_conf.json.
+After a run the keys are stored in run_key.json next to the MFILE together
+with the PROCESS version and git tag from the MFILE (procver, tagno) and
+the hash of the MFILE itself. A case is not run again while its input, the
+PROCESS build (procver and tagno of the installed PROCESS) and the MFILE
+are unchanged.
+'''
+from stellarator_analysis.scripts.mfile_reader import read_values
+from stellarator_analysis.scripts.indat_model import InDatModel
+from stellarator_analysis.scripts.results_store import file_hash
+from importlib import metadata, util
+from functools import lru_cache
+import subprocess
+import hashlib
+import json
+import os
+
+RECORD_NAME = 'run_key.json'
+
+
+def input_key(case_dir, prefix='squid'):
+    """
+    SHA-256 of the IN.DAT content and the canonical stella_conf.json.
+    """
+    digest = hashlib.sha256()
+    digest.update(InDatModel.from_file(os.path.join(case_dir, prefix + '.IN.DAT')).semantic_key().encode())
+    conf_path = os.path.join(case_dir, prefix + '.stella_conf.json')
+    if os.path.isfile(conf_path):
+        with open(conf_path) as f:
+            digest.update(json.dumps(json.load(f), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def process_version():
+    """
+    Version of the installed PROCESS package, None if it cannot be determined.
+    """
+    try:
+        return metadata.version('process')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def process_tag():
+    """
+    Git tag of the installed PROCESS as written to the MFILE tagno (git
+    describe of its source tree), None if PROCESS is not installed from a
+    git checkout.
+    """
+    spec = util.find_spec('process')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    try:
+        result = subprocess.run(['git', 'describe', '--tags'], cwd=list(spec.submodule_search_locations)[0],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+
+def process_build():
+    """
+    (procver, tagno) of the installed PROCESS, each None if unknown.
+    """
+    return process_version(), process_tag()
+
+
+def write_record(case_dir, prefix, keys):
+    """
+    Store the keys of a finished case (the input it was generated with and
+    the input it finally ran with) with the version information and
+    outcome read from its MFILE. Nothing is written if there is no MFILE.
+    """
+    mfile_path = os.path.join(case_dir, prefix + '.MFILE.DAT')
+    if not os.path.isfile(mfile_path):
+        return None
+    values = read_values(mfile_path, ['procver', 'tagno', 'ifail'])
+    record = {'keys': list(keys),
+              'procver': values.get('procver', ''),
+              'tagno': values.get('tagno', ''),
+              'ifail': values.get('ifail'),
+              'mfile_sha256': file_hash(mfile_path)}
+    with open(os.path.join(case_dir, RECORD_NAME), 'w') as f:
+        json.dump(record, f, indent=4)
+    return record
+
+
+def cached(case_dir, prefix, key, rerun_failed=False):
+    """
+    Stored record of a case if its result can be reused for key, else None.
+    A record of another PROCESS version or git tag than the installed one
+    is not reused.
+    """
+    record_path = os.path.join(case_dir, RECORD_NAME)
+    mfile_path = os.path.join(case_dir, prefix + '.MFILE.DAT')
+    if not (os.path.isfile(record_path) and os.path.isfile(mfile_path)):
+        return None
+    with open(record_path) as f:
+        record = json.load(f)
+
+    if key not in record.get('keys', []) or record.get('ifail') is None:
+        return None
+    if rerun_failed and record['ifail'] != 1:
+        return None
+    version, tag = process_build()
+    if version is not None and str(record.get('procver', '')).strip() != version:
+        return None
+    if tag is not None and str(record.get('tagno', '')).strip() != tag:
+        return None
+    if record.get('mfile_sha256') != file_hash(mfile_path):
+        return None
+    return record
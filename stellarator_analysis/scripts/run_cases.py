@@ -0,0 +1,458 @@
+'''
+Run all cases of a scan, each case directory holds its own run_me.py
+
+Cases are independent, so they are dispatched onto a bounded pool and the
+wall time of a scan is close to that of its slowest case. In continuation mode
+cases are started along the scan variable, each one warm-started from the
+nearest converged neighbour. Cases which do not converge are queued again with
+the strategies of a retry ladder until one converges or the per-case
+wall-clock budget is used up. Cases whose inputs did not change since their
+last run are not run again (see run_cache). The runtime of every case is
+recorded in its telemetry (see telemetry). Cases listed in the manifest
+of a scan (see case_inputs) get their directory just before they are run.
+With in_process, cases are run by long-lived worker processes which import
+PROCESS once (see process_worker) instead of one run_me.py each.
+'''
+from stellarator_analysis.scripts.results_store import scan_value_from_case
+from stellarator_analysis.scripts.retry import RetryContext, DEFAULT_LADDER
+from stellarator_analysis.scripts import case_inputs, mfile_sidecar, process_worker, run_cache, warm_start
+from stellarator_analysis.scripts import summary_report, telemetry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, asdict
+from contextlib import nullcontext
+import numpy as np
+import multiprocessing
+import subprocess
+import json
+import sys
+import os
+import time
+
+
+@dataclass
+class CaseRun:
+    """
+    Outcome of a case, summed over all its attempts.
+    """
+    case: str
+    case_dir: str
+    returncode: int = None
+    elapsed: float = 0.0
+    log: str = ''
+    warm_start_from: str = ''
+    attempts: int = 0
+    converged: bool = False
+    strategy: str = ''
+
+
+def available_cores():
+    """
+    Number of cores this process is allowed to use.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_size(max_workers, n_cases):
+    """
+    Number of workers to use, max_workers defaults to the available cores.
+    """
+    if max_workers is None:
+        max_workers = available_cores()
+    return max(1, min(max_workers, n_cases))
+
+
+def list_case_dirs(results_dir):
+    """
+    Case directories in results_dir which contain a run_me.py or are listed
+    in its manifest, sorted by name.
+    """
+    case_dirs = {os.path.join(results_dir, case) for case in os.listdir(results_dir)
+                 if os.path.isfile(os.path.join(results_dir, case, 'run_me.py'))}
+    case_dirs.update(case_inputs.manifest_case_dirs(results_dir))
+    return sorted(case_dirs)
+
+
+def run_case(case_dir, prefix='squid', timeout=None):
+    """
+    Run PROCESS for one case in its own working directory.
+    stdout and stderr go to run.log in the case directory, a run killed after
+    timeout seconds gets returncode None.
+    """
+    run = CaseRun(case=os.path.basename(case_dir), case_dir=case_dir,
+                  log=os.path.join(case_dir, 'run.log'))
+    start = time.perf_counter()
+    with open(run.log, 'w') as log:
+        try:
+            process = subprocess.run([sys.executable, 'run_me.py', '-n', prefix],
+                                     cwd=case_dir, stdout=log, stderr=subprocess.STDOUT,
+                                     timeout=timeout)
+            run.returncode = process.returncode
+        except subprocess.TimeoutExpired:
+            print(f'Run killed after {timeout:.0f} s', file=log)
+    run.elapsed = time.perf_counter() - start
+    return run
+
+
+class WorkerPool:
+    """
+    Worker processes which import PROCESS once and run many cases each.
+    Used as the run function of a Scheduler, pool(case_dir, prefix, timeout)
+    runs a case in the next free worker and returns its CaseRun. The
+    workers are forked and import PROCESS before the first case is
+    submitted. If a worker dies, e.g. in a crash of PROCESS, its case
+    fails and the pool is marked broken. The Scheduler then holds back new
+    cases until none is running and calls restart() from its main thread,
+    so workers are never forked from a scheduler thread.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.broken = False
+        self.executor = self.start()
+
+    def start(self):
+        executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=process_worker.initialise)
+        executor.submit(process_worker.initialise).result()
+        return executor
+
+    def restart(self):
+        """
+        Replace a broken pool. Call from the main thread only.
+        """
+        self.executor.shutdown()
+        self.executor = self.start()
+        self.broken = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown()
+
+    def __call__(self, case_dir, prefix='squid', timeout=None):
+        run = CaseRun(case=os.path.basename(case_dir), case_dir=case_dir,
+                      log=os.path.join(case_dir, 'run.log'))
+        try:
+            run.returncode, run.elapsed = self.executor.submit(process_worker.run_case, case_dir, prefix,
+                                                               timeout).result()
+        except BrokenProcessPool:
+            with open(run.log, 'a') as log:
+                print('PROCESS worker terminated abruptly', file=log)
+            run.returncode = -1
+            self.broken = True
+        return run
+
+
+def is_converged(case_dir, prefix='squid'):
+    """
+    True if the MFILE of a case reports a feasible solution (ifail == 1).
+    """
+    try:
+        return warm_start.read_solution(os.path.join(case_dir, prefix + '.MFILE.DAT')) is not None
+    except (KeyError, ValueError):
+        return False
+
+
+class Scheduler:
+    """
+    Bounded pool of PROCESS runs with optional continuation and retries.
+    Cases are ordered and matched to neighbours by their scan value, or by
+    positions ({case name: coordinates}) for scans of several variables.
+    """
+
+    def __init__(self, case_dirs, prefix='squid', max_workers=None, run=run_case,
+                 ladder=DEFAULT_LADDER, case_budget=3600.0, var_name=None, use_cache=True,
+                 rerun_failed=False, positions=None):
+        if positions is None:
+            positions = {os.path.basename(case_dir): (scan_value_from_case(os.path.basename(case_dir)),)
+                         for case_dir in case_dirs}
+        self.case_dirs = sorted(case_dirs, key=lambda case_dir: tuple(positions[os.path.basename(case_dir)]))
+        self.values = [np.asarray(positions[os.path.basename(case_dir)], dtype=float) for case_dir in self.case_dirs]
+        self.prefix = prefix
+        self.max_workers = pool_size(max_workers, len(case_dirs))
+        self.run = run
+        self.ladder = list(ladder) if ladder else []
+        self.case_budget = case_budget
+        self.exclude = tuple(var_name) if isinstance(var_name, (list, tuple)) else (var_name,) if var_name else ()
+        self.use_cache = use_cache
+        self.rerun_failed = rerun_failed
+
+        self.case_runs = [CaseRun(case=os.path.basename(case_dir), case_dir=case_dir) for case_dir in self.case_dirs]
+        self.converged = []
+        self.pending = set()
+        self.continuation = False
+        self._running = {}
+        self._cached = []
+        self._keys = {}
+        self._next_strategy = [0] * len(self.case_dirs)
+        self._original_input = {}
+        self._start_point = {}
+        self._started = {}
+        self._deferred = []
+        self._done = 0
+
+    def indat_path(self, idx):
+        return os.path.join(self.case_dirs[idx], self.prefix + '.IN.DAT')
+
+    def mfile_path(self, idx):
+        return os.path.join(self.case_dirs[idx], self.prefix + '.MFILE.DAT')
+
+    def nearest_converged(self, idx):
+        """
+        Index of the converged case closest in scan position (over all
+        dimensions of a grid scan), None if there is none.
+        """
+        candidates = [j for j in self.converged if j != idx]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda j: float(np.linalg.norm(self.values[j] - self.values[idx])))
+
+    def execute(self, first, continuation=False):
+        """
+        Start the cases with indices in first and run until all cases are done.
+        With continuation the remaining cases are released as neighbours finish.
+        """
+        self.continuation = continuation
+        self.pending = set(range(len(self.case_dirs))) - set(first)
+        self._start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            self._pool = pool
+            for idx in first:
+                self.submit(idx, warm=continuation)
+            while self._running or self._cached or self._deferred:
+                while self._cached:
+                    self.finished_cached(self._cached.pop())
+                if self._deferred and not self._running:
+                    self.run.restart()
+                    deferred, self._deferred = self._deferred, []
+                    for args in deferred:
+                        self.start_run(*args)
+                    continue
+                if not self._running:
+                    continue
+                finished, _ = wait(self._running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    idx, strategy = self._running.pop(future)
+                    self.finished(idx, strategy, future.result())
+        return self.summary()
+
+    def submit(self, idx, warm=False, strategy='', timeout=None):
+        case_run = self.case_runs[idx]
+        if idx not in self._keys:
+            self._started[idx] = time.time()
+            case_inputs.materialise(self.case_dirs[idx])
+            self._keys[idx] = run_cache.input_key(self.case_dirs[idx], self.prefix)
+            if self.use_cache and run_cache.cached(self.case_dirs[idx], self.prefix, self._keys[idx],
+                                                   self.rerun_failed):
+                self._cached.append(idx)
+                return
+        if warm:
+            nearest = self.nearest_converged(idx)
+            if nearest is not None and warm_start.warm_start(self.indat_path(idx), self.mfile_path(nearest),
+                                                             self.exclude):
+                case_run.warm_start_from = self.case_runs[nearest].case
+        self.start_run(idx, strategy, timeout)
+
+    def start_run(self, idx, strategy='', timeout=None):
+        """
+        Hand a case to the run function, or hold it back while a broken
+        WorkerPool waits for its restart.
+        """
+        if getattr(self.run, 'broken', False):
+            self._deferred.append((idx, strategy, timeout))
+            return
+        future = self._pool.submit(self.run, self.case_dirs[idx], self.prefix, timeout)
+        self._running[future] = (idx, strategy)
+
+    def finished(self, idx, strategy, attempt):
+        case_run = self.case_runs[idx]
+        case_run.attempts += 1
+        case_run.elapsed += attempt.elapsed
+        case_run.returncode = attempt.returncode
+        case_run.log = attempt.log
+        first_attempt = case_run.attempts == 1
+
+        if is_converged(self.case_dirs[idx], self.prefix):
+            case_run.converged = True
+            case_run.strategy = strategy or 'initial'
+            self.converged.append(idx)
+            self.case_done(idx)
+        elif not self.retry(idx):
+            if idx in self._original_input:
+                with open(self.indat_path(idx), 'w') as f:
+                    f.write(self._original_input[idx])
+            self.case_done(idx)
+
+        if self.continuation and first_attempt:
+            self.release_neighbours(idx)
+
+    def finished_cached(self, idx):
+        """
+        Take the result of a case from its previous run.
+        """
+        case_run = self.case_runs[idx]
+        case_run.returncode = 0
+        case_run.strategy = 'cached'
+        case_run.converged = is_converged(self.case_dirs[idx], self.prefix)
+        if case_run.converged:
+            self.converged.append(idx)
+        self._done += 1
+        status = 'converged' if case_run.converged else 'not converged'
+        print(f'[{self._done}/{len(self.case_dirs)}] {case_run.case}: unchanged, {status} in previous run')
+        if self.continuation:
+            self.release_neighbours(idx)
+
+    def release_neighbours(self, idx):
+        for neighbour in (idx - 1, idx + 1):
+            if neighbour in self.pending:
+                self.pending.remove(neighbour)
+                self.submit(neighbour, warm=True)
+
+    def retry(self, idx):
+        """
+        Queue a failed case again with the next applicable strategy of the
+        ladder. Returns False if the ladder or the budget is exhausted.
+        """
+        case_run = self.case_runs[idx]
+        if idx not in self._original_input:
+            with open(self.indat_path(idx)) as f:
+                self._original_input[idx] = f.read()
+            try:
+                self._start_point[idx] = warm_start.read_start_point(self.mfile_path(idx)) or {}
+            except (KeyError, ValueError):
+                self._start_point[idx] = {}
+
+        while self._next_strategy[idx] < len(self.ladder):
+            remaining = self.case_budget - case_run.elapsed
+            if remaining <= 0:
+                return False
+            strategy = self.ladder[self._next_strategy[idx]]
+            self._next_strategy[idx] += 1
+
+            with open(self.indat_path(idx), 'w') as f:
+                f.write(self._original_input[idx])
+            nearest = self.nearest_converged(idx)
+            context = RetryContext(case=case_run.case,
+                                   indat_path=self.indat_path(idx),
+                                   attempt=case_run.attempts,
+                                   start_point=self._start_point[idx],
+                                   neighbour_mfile=None if nearest is None else self.mfile_path(nearest),
+                                   exclude=self.exclude)
+            if strategy.apply(context):
+                print(f'{case_run.case}: not converged, retrying with {strategy.name}')
+                self.submit(idx, strategy=strategy.name, timeout=remaining)
+                return True
+        return False
+
+    def case_done(self, idx):
+        self._done += 1
+        case_run = self.case_runs[idx]
+        keys = {self._keys[idx], run_cache.input_key(self.case_dirs[idx], self.prefix)}
+        run_cache.write_record(self.case_dirs[idx], self.prefix, sorted(keys))
+        mfile_path = os.path.join(self.case_dirs[idx], self.prefix + '.MFILE.DAT')
+        telemetry.update(self.case_dirs[idx], self.prefix, since=self._started[idx], attempts=case_run.attempts,
+                         elapsed=case_run.elapsed, strategy=case_run.strategy, returncode=case_run.returncode,
+                         converged=case_run.converged)
+        if os.path.isfile(mfile_path) and not mfile_sidecar.is_fresh(mfile_path):
+            mfile_sidecar.write_sidecar(mfile_path)
+        if case_run.converged:
+            status = 'converged' if case_run.strategy == 'initial' else f'converged with {case_run.strategy}'
+        elif case_run.returncode == 0:
+            status = 'not converged'
+        else:
+            status = f'failed ({case_run.returncode}), see {case_run.log}'
+        if case_run.warm_start_from:
+            status += f', warm start from {case_run.warm_start_from}'
+        print(f'[{self._done}/{len(self.case_dirs)}] {case_run.case}: {status} after {case_run.attempts} '
+              f'attempt(s) in {case_run.elapsed:.1f} s ({time.perf_counter() - self._start:.1f} s elapsed)')
+
+    def summary(self):
+        """
+        Print the timing and retry summary and return the case runs.
+        """
+        total = sum(case_run.elapsed for case_run in self.case_runs)
+        wall = time.perf_counter() - self._start
+        n_cached = sum(case_run.strategy == 'cached' for case_run in self.case_runs)
+        print(f'Finished {len(self.case_runs)} cases in {wall:.1f} s wall time ({total:.1f} s summed case time, '
+              f'{n_cached} unchanged cases not rerun)')
+
+        strategies = {}
+        for case_run in self.case_runs:
+            strategies.setdefault(case_run.strategy or 'not converged', []).append(case_run.case)
+        for strategy, cases in strategies.items():
+            print(f'  {strategy}: {len(cases)} ({", ".join(cases)})')
+        return sorted(self.case_runs, key=lambda case_run: case_run.case)
+
+
+def write_summary(runs, results_dir, filename='run_summary.json'):
+    """
+    Write the per-case outcome (attempts, strategy, elapsed time) as JSON.
+    """
+    with open(os.path.join(results_dir, filename), 'w') as f:
+        json.dump([asdict(case_run) for case_run in runs], f, indent=4)
+
+
+def run_all(case_dirs, prefix='squid', max_workers=None, run=run_case, **kwargs):
+    """
+    Run case_dirs on a pool of at most max_workers concurrent PROCESS runs
+    and print progress as cases finish.
+    """
+    if not case_dirs:
+        return []
+    scheduler = Scheduler(case_dirs, prefix, max_workers, run, **kwargs)
+    print(f'Running {len(case_dirs)} cases on {scheduler.max_workers} workers')
+    return scheduler.execute(range(len(case_dirs)))
+
+
+def run_continuation(case_dirs, prefix='squid', max_workers=None, run=run_case, **kwargs):
+    """
+    Run case_dirs ordered along the scan variable.
+    Evenly spaced seed cases start cold, every finished case releases its
+    neighbours, which are warm-started from the nearest converged case.
+    The scan variable (var_name) is never overwritten by the warm start.
+    """
+    if not case_dirs:
+        return []
+    scheduler = Scheduler(case_dirs, prefix, max_workers, run, **kwargs)
+    n, workers = len(case_dirs), scheduler.max_workers
+    seeds = sorted({round((i + 0.5) * n / workers - 0.5) for i in range(workers)})
+    print(f'Running {n} cases in continuation mode on {workers} workers')
+    return scheduler.execute(seeds, continuation=True)
+
+
+def main(case_name, prefix='squid', workdir=None, max_workers=None, continuation=False, var_name=None,
+         retries=True, case_budget=3600.0, use_cache=True, rerun_failed=False, in_process=False,
+         report=False):
+    """
+    Run every case in workdir/case_name.
+    max_workers defaults to the number of available cores. With continuation
+    the cases are warm-started along the scan of var_name. With retries,
+    non-converged cases are rerun with the strategies of the retry ladder
+    within case_budget seconds of wall time per case. With use_cache, cases
+    whose inputs and PROCESS version match their last run are skipped
+    (failed ones too, unless rerun_failed). With in_process the cases are
+    run in a WorkerPool instead of one interpreter per case. With report the
+    summary pages of the finished cases are rendered afterwards, see
+    summary_report.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    results_dir = os.path.join(workdir, case_name)
+    case_dirs = list_case_dirs(results_dir)
+    options = dict(ladder=DEFAULT_LADDER if retries else [], case_budget=case_budget, var_name=var_name,
+                   use_cache=use_cache, rerun_failed=rerun_failed)
+    runner = WorkerPool(pool_size(max_workers, len(case_dirs))) if in_process else nullcontext(run_case)
+    with runner as run:
+        if continuation:
+            runs = run_continuation(case_dirs, prefix=prefix, max_workers=max_workers, run=run, **options)
+        else:
+            runs = run_all(case_dirs, prefix=prefix, max_workers=max_workers, run=run, **options)
+    write_summary(runs, results_dir)
+    if report:
+        summary_report.render_reports([run.case_dir for run in runs], prefix, max_workers)
+    return runs
@@ -0,0 +1,101 @@
+import time
+start_time = time.perf_counter()
+
+from process.main import SingleRun, VaryRun
+
+from pathlib import Path
+import argparse
+import subprocess
+import resource
+import json
+import os, sys
+
+
+def timed(method, phases, phase):
+    # Add the time spent in method to phases[phase]
+    def wrapper(*args, **kwargs):
+        phase_start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - phase_start
+    return wrapper
+
+
+def write_telemetry(script_dir, prefix, phases):
+    # Runtime of this run, the fields are described in stellarator_analysis/scripts/telemetry.py
+    times = os.times()
+    telemetry = {
+        "wall_time": time.perf_counter() - start_time,
+        "cpu_time": times.user + times.system,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "phases": phases,
+        "mode": "run_me",
+    }
+    with open(os.path.join(script_dir, prefix + ".telemetry.json"), "w") as f:
+        json.dump(telemetry, f, indent=4)
+
+
+if __name__ == "__main__":
+
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser(
+        prog='run_PROCESS',
+        description="Run PROCESS with IN.DAT file present in the same directory",
+    )
+    parser.add_argument("-n", "--input_name", "-v")
+    args = parser.parse_args()
+
+    if args.input_name is not None:
+        prefix = args.input_name
+    else:
+        prefix = "squid"
+        # prefix = "transition"
+        # prefix = "updated"
+        # prefix = "rebuild"
+        # prefix = "helias5"
+        
+
+    # Run process on an input file, timing the input, solve and output phases
+
+    phases = {"import": time.perf_counter() - start_time}
+    try:
+        phase_start = time.perf_counter()
+        single_run = SingleRun(script_dir+'/'+prefix+".IN.DAT")
+        phases["input"] = time.perf_counter() - phase_start
+
+        for method_name in ("finish", "append_input"):
+            if hasattr(single_run, method_name):
+                setattr(single_run, method_name, timed(getattr(single_run, method_name), phases, "output"))
+        phase_start = time.perf_counter()
+        single_run.run()
+        phases["solve"] = time.perf_counter() - phase_start - phases.get("output", 0.0)
+    finally:
+        write_telemetry(script_dir, prefix, phases)
+
+    # vary_run = VaryRun(script_dir+'/'+prefix+".IN.DAT")
+    # vary_run.run()
+
+    # Generate pdf with results
+    # postprocess(single_run)
+
+def postprocess(single_run):
+    # Postprocess the results
+    #print(single_run.mfile_path)
+    # The summaries of a whole scan are rendered faster in one batch by
+    # stellarator_analysis/scripts/summary_report.py
+    from process.io import plot_proc
+    from pdf2image import convert_from_path
+
+    # plot_proc uses command line arguments of the current process. Running plot proc in its own process isolates it from the command line arguments
+    subprocess.run([sys.executable, plot_proc.__file__, "-f", str(single_run.mfile_path)])
+
+    # Create a summary PDF
+    # Convert PDF to PNG in order to display in notebook
+    summary_pdf = str(single_run.mfile_path) + "SUMMARY.pdf"
+    print(summary_pdf)
+    pages = convert_from_path(summary_pdf)
+    for page_no, page_image in enumerate(pages):
+        png_path = Path(script_dir) / f"plot_proc_{page_no + 1}.png"
+        page_image.save(png_path, "PNG")
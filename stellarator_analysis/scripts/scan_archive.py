@@ -0,0 +1,311 @@
+'''
+Deduplicated, compressed archive of a finished scan ("pack scan")
+
+A scan results directory is packed into one <results_dir>.scanpack file,
+a ZIP archive with LZMA compressed members, so every case can be read
+without unpacking the rest:
+
+    manifest.json                     cases, files and how to rebuild them
+    blobs/<sha256>                    content stored once for all cases
+    cases/<case>/<file>.delta.json    line delta of a text file against the
+                                      same file of the first case
+    cases/<case>/<file>.f8            numbers taken out of the text, float64
+    cases/<case>/<file>.dec           their number of decimals, uint8
+
+Floating point numbers written as d.ddd...e+XX (the MFILE values) are
+taken out of text files and stored as byte-shuffled float64, which
+compresses far better than their text. What remains of the text, the
+template, is nearly identical between cases and is stored either once as a
+blob or as a line delta against the first case. Numbers whose text would
+not be reproduced exactly stay in the template, so unpacking restores
+every file byte for byte. Derived files (the results store, sidecars) are
+not archived, they are rebuilt from the MFILEs.
+'''
+from stellarator_analysis.scripts.mfile_reader import parse_lines
+import numpy as np
+import argparse
+import difflib
+import hashlib
+import zipfile
+import json
+import os
+import re
+
+ARCHIVE_VERSION = 1
+NUMBER_PATTERN = re.compile(r'-?\d\.(\d+)e([+-]\d+)')
+PLACEHOLDER = '\0'
+SKIP_SUFFIXES = ('.results.npz', '.grid.npz', '.MFILE.bin', '.tmp')
+
+
+def archive_path_for(results_dir):
+    return os.path.normpath(results_dir) + '.scanpack'
+
+
+def split_numbers(text):
+    """
+    (template, float64 values, uint8 decimals) of a text. Every number that
+    is reproduced exactly by format(value, f'.{decimals}e') is replaced by
+    PLACEHOLDER in the template.
+    """
+    pieces = []
+    values = []
+    decimals = []
+    last = 0
+    for match in NUMBER_PATTERN.finditer(text):
+        token = match.group(0)
+        n_decimals = len(match.group(1))
+        value = float(token)
+        if n_decimals > 255 or format(value, f'.{n_decimals}e') != token:
+            continue
+        pieces.append(text[last:match.start()])
+        values.append(value)
+        decimals.append(n_decimals)
+        last = match.end()
+    pieces.append(text[last:])
+    return PLACEHOLDER.join(pieces), np.array(values, dtype='<f8'), np.array(decimals, dtype=np.uint8)
+
+
+def join_numbers(template, values, decimals):
+    """
+    Inverse of split_numbers.
+    """
+    pieces = template.split(PLACEHOLDER)
+    out = [pieces[0]]
+    for piece, value, n_decimals in zip(pieces[1:], values.tolist(), decimals.tolist()):
+        out.append(format(value, f'.{n_decimals}e'))
+        out.append(piece)
+    return ''.join(out)
+
+
+def shuffle(values):
+    """
+    Byte-shuffled float64 data: all first bytes, then all second bytes, ...
+    """
+    return np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def unshuffle(data):
+    return np.frombuffer(np.frombuffer(data, dtype=np.uint8).reshape(8, -1).T.tobytes(), dtype='<f8')
+
+
+def line_delta(base_lines, lines):
+    """
+    Delta of lines against base_lines: a list of [start, end] ranges of
+    base lines to copy and strings of new lines.
+    """
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        else:
+            delta.extend(lines[j1:j2])
+    return delta
+
+
+def apply_delta(base_lines, delta):
+    lines = []
+    for item in delta:
+        if isinstance(item, list):
+            lines.extend(base_lines[item[0]:item[1]])
+        else:
+            lines.append(item)
+    return ''.join(lines)
+
+
+def is_archived(filename):
+    return not filename.endswith(SKIP_SUFFIXES)
+
+
+class ScanPacker:
+    """
+    Writes the members of an archive, storing every blob once.
+    """
+
+    def __init__(self, zf):
+        self.zf = zf
+        self.blobs = set()
+        self.bases = {}
+
+    def blob(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.blobs:
+            self.zf.writestr(f'blobs/{digest}', data)
+            self.blobs.add(digest)
+        return digest
+
+    def add_file(self, member_prefix, filename, data):
+        """
+        Store one file and return its manifest entry.
+        """
+        try:
+            text = data.decode()
+        except UnicodeDecodeError:
+            return {'blob': self.blob(data)}
+        if PLACEHOLDER in text:
+            return {'blob': self.blob(data)}
+
+        template, values, decimals = split_numbers(text)
+        entry = {}
+        if len(values):
+            self.zf.writestr(f'{member_prefix}.f8', shuffle(values))
+            self.zf.writestr(f'{member_prefix}.dec', decimals.tobytes())
+            entry['numbers'] = len(values)
+
+        template_bytes = template.encode()
+        digest = hashlib.sha256(template_bytes).hexdigest()
+        base = self.bases.get(filename)
+        if digest in self.blobs or base is None:
+            entry['template'] = self.blob(template_bytes)
+            self.bases.setdefault(filename, (entry['template'], template.splitlines(keepends=True)))
+            return entry
+
+        delta = line_delta(base[1], template.splitlines(keepends=True))
+        delta_bytes = json.dumps(delta).encode()
+        if len(delta_bytes) < len(template_bytes) // 2:
+            self.zf.writestr(f'{member_prefix}.delta.json', delta_bytes)
+            entry['base'] = base[0]
+        else:
+            entry['template'] = self.blob(template_bytes)
+        return entry
+
+
+def pack_scan(results_dir, archive_path=None, verbose=True):
+    """
+    Pack all case directories and top level files of results_dir into an
+    archive and return its path.
+    """
+    if archive_path is None:
+        archive_path = archive_path_for(results_dir)
+    manifest = {'version': ARCHIVE_VERSION, 'files': {}, 'cases': {}}
+    raw_size = 0
+    tmp_path = archive_path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_LZMA) as zf:
+        packer = ScanPacker(zf)
+        for name in sorted(os.listdir(results_dir)):
+            path = os.path.join(results_dir, name)
+            if os.path.isfile(path) and is_archived(name):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                raw_size += len(data)
+                manifest['files'][name] = {'blob': packer.blob(data)}
+            elif os.path.isdir(path):
+                files = {}
+                for filename in sorted(os.listdir(path)):
+                    file_path = os.path.join(path, filename)
+                    if not (os.path.isfile(file_path) and is_archived(filename)):
+                        continue
+                    with open(file_path, 'rb') as f:
+                        data = f.read()
+                    raw_size += len(data)
+                    files[filename] = packer.add_file(f'cases/{name}/{filename}', filename, data)
+                manifest['cases'][name] = files
+        zf.writestr('manifest.json', json.dumps(manifest, indent=1))
+    os.replace(tmp_path, archive_path)
+
+    if verbose:
+        packed_size = os.path.getsize(archive_path)
+        print(f'Packed {len(manifest["cases"])} cases, {raw_size / 2 ** 20:.1f} MB into {archive_path}, '
+              f'{packed_size / 2 ** 20:.2f} MB ({raw_size / packed_size:.0f}x smaller)')
+    return archive_path
+
+
+class ScanArchive:
+    """
+    Random access to the cases of a packed scan.
+    """
+
+    def __init__(self, archive_path):
+        self.path = archive_path
+        self.zf = zipfile.ZipFile(archive_path)
+        self.manifest = json.loads(self.zf.read('manifest.json'))
+        if self.manifest['version'] != ARCHIVE_VERSION:
+            raise ValueError(f'{archive_path} has archive version {self.manifest["version"]}, '
+                             f'expected {ARCHIVE_VERSION}')
+        self.cases = sorted(self.manifest['cases'])
+        self._base_lines = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+
+    def files(self, case):
+        return sorted(self.manifest['cases'][case])
+
+    def _template(self, member_prefix, entry):
+        if 'template' in entry:
+            return self.zf.read(f'blobs/{entry["template"]}').decode()
+        base = self._base_lines.get(entry['base'])
+        if base is None:
+            base = self.zf.read(f'blobs/{entry["base"]}').decode().splitlines(keepends=True)
+            self._base_lines[entry['base']] = base
+        return apply_delta(base, json.loads(self.zf.read(f'{member_prefix}.delta.json')))
+
+    def read_file(self, case, filename):
+        """
+        Original content of one file of a case as bytes.
+        """
+        entry = self.manifest['cases'][case][filename]
+        if 'blob' in entry:
+            return self.zf.read(f'blobs/{entry["blob"]}')
+        member_prefix = f'cases/{case}/{filename}'
+        template = self._template(member_prefix, entry)
+        if 'numbers' not in entry:
+            return template.encode()
+        values = unshuffle(self.zf.read(f'{member_prefix}.f8'))
+        decimals = np.frombuffer(self.zf.read(f'{member_prefix}.dec'), dtype=np.uint8)
+        return join_numbers(template, values, decimals).encode()
+
+    def read_values(self, case, names=None, prefix='squid'):
+        """
+        {name: value} of the MFILE of one case, see mfile_reader.read_values.
+        """
+        text = self.read_file(case, prefix + '.MFILE.DAT').decode()
+        return parse_lines(text.splitlines(keepends=True), names)[0]
+
+    def extract_case(self, case, dest_dir):
+        """
+        Write all files of one case to dest_dir/case.
+        """
+        case_dir = os.path.join(dest_dir, case)
+        os.makedirs(case_dir, exist_ok=True)
+        for filename in self.files(case):
+            with open(os.path.join(case_dir, filename), 'wb') as f:
+                f.write(self.read_file(case, filename))
+        return case_dir
+
+
+def unpack_scan(archive_path, dest_dir):
+    """
+    Restore a packed scan into dest_dir.
+    """
+    with ScanArchive(archive_path) as archive:
+        os.makedirs(dest_dir, exist_ok=True)
+        for name, entry in archive.manifest['files'].items():
+            with open(os.path.join(dest_dir, name), 'wb') as f:
+                f.write(archive.zf.read(f'blobs/{entry["blob"]}'))
+        for case in archive.cases:
+            archive.extract_case(case, dest_dir)
+    return dest_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='scan_archive', description='Pack or unpack a scan results directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack = commands.add_parser('pack')
+    pack.add_argument('results_dir')
+    pack.add_argument('-o', '--output', default=None)
+    unpack = commands.add_parser('unpack')
+    unpack.add_argument('archive')
+    unpack.add_argument('dest_dir')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        pack_scan(args.results_dir, args.output)
+    else:
+        unpack_scan(args.archive, args.dest_dir)
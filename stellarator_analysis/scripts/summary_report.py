@@ -0,0 +1,177 @@
+'''
+PROCESS summary pages (plot_proc) of many cases rendered in one batch
+
+run_me.py used to run plot_proc as a new interpreter per case, which wrote
+<mfile>SUMMARY.pdf, and then rasterised the PDF page by page with
+pdf2image. Here a few worker processes import plot_proc once and render the
+summary of case after case. The PdfPages that plot_proc writes its pages to
+is replaced by PngPages, which saves every page figure directly as
+<case>/plot_proc_<page>.png, so no PDF is written or converted.
+
+Pages are only rendered again if the MFILE is newer than the first page,
+so the report of a scan can be brought up to date after every run:
+
+    summary_report.main('results', workdir=workdir)
+'''
+from stellarator_analysis.scripts import results_store
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import glob
+import sys
+import os
+
+DPI = 200
+PAGE_NAME = 'plot_proc_{}.png'
+
+_plot_proc = None
+_pages = []
+
+
+class PngPages:
+    """
+    Stand-in for matplotlib's PdfPages: every page is saved as a PNG in the
+    directory of the PDF it replaces.
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        self.directory = os.path.dirname(os.path.abspath(str(filename)))
+        self.n_pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def savefig(self, figure=None, **kwargs):
+        from matplotlib import pyplot
+        if figure is None:
+            figure = pyplot.gcf()
+        elif isinstance(figure, int):
+            figure = pyplot.figure(figure)
+        kwargs.pop('format', None)
+        kwargs.setdefault('dpi', DPI)
+        self.n_pages += 1
+        path = os.path.join(self.directory, PAGE_NAME.format(self.n_pages))
+        figure.savefig(path, format='png', **kwargs)
+        _pages.append(path)
+
+    def get_pagecount(self):
+        return self.n_pages
+
+    def infodict(self):
+        return {}
+
+    def attach_note(self, text, positionRect=None):
+        pass
+
+
+def initialise():
+    """
+    Import plot_proc once per worker, with PngPages in place of PdfPages.
+    """
+    global _plot_proc
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.backends import backend_pdf
+    backend_pdf.PdfPages = PngPages
+    from process.io import plot_proc
+    if hasattr(plot_proc, 'PdfPages'):
+        plot_proc.PdfPages = PngPages
+    _plot_proc = plot_proc
+
+
+def page_paths(case_dir):
+    """
+    Summary pages of a case, in page order.
+    """
+    paths = glob.glob(os.path.join(case_dir, PAGE_NAME.format('*')))
+    return sorted(paths, key=lambda path: int(path.rsplit('_', 1)[-1][:-len('.png')]))
+
+
+def is_up_to_date(case_dir, prefix='squid'):
+    """
+    True if the first summary page is at least as new as the MFILE.
+    """
+    first_page = os.path.join(case_dir, PAGE_NAME.format(1))
+    mfile_path = os.path.join(case_dir, prefix + '.MFILE.DAT')
+    return os.path.isfile(first_page) and os.stat(first_page).st_mtime_ns >= os.stat(mfile_path).st_mtime_ns
+
+
+def render_case(case_dir, prefix='squid'):
+    """
+    Render the summary pages of one case in this worker and return
+    (case_dir, page paths, error message or None).
+    """
+    if _plot_proc is None:
+        initialise()
+    from matplotlib import pyplot
+    mfile_path = os.path.join(case_dir, prefix + '.MFILE.DAT')
+    old_pages = page_paths(case_dir)
+    del _pages[:]
+    argv = sys.argv
+    sys.argv = ['plot_proc', '-f', mfile_path]
+    try:
+        _plot_proc.main(args=['-f', mfile_path])
+        error = None
+    except (Exception, SystemExit) as exception:
+        error = repr(exception)
+    finally:
+        sys.argv = argv
+        pyplot.close('all')
+    pages = list(_pages)
+    if error is None:
+        for path in old_pages:
+            if path not in pages:
+                os.remove(path)
+    return case_dir, pages, error
+
+
+def render_reports(case_dirs, prefix='squid', max_workers=None, force=False):
+    """
+    Render the summary pages of all finished cases of case_dirs whose pages
+    are missing or older than the MFILE (all of them with force) on a pool
+    of max_workers (default: all CPUs). Returns {case_dir: page paths}.
+    """
+    pending = [case_dir for case_dir in case_dirs
+               if os.path.isfile(os.path.join(case_dir, prefix + '.MFILE.DAT'))
+               and (force or not is_up_to_date(case_dir, prefix))]
+    if not pending:
+        print(f'Summary pages of {len(case_dirs)} cases are up to date')
+        return {}
+
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(pending)))
+    reports = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=initialise) as pool:
+        futures = [pool.submit(render_case, case_dir, prefix) for case_dir in pending]
+        for i, future in enumerate(as_completed(futures)):
+            case_dir, pages, error = future.result()
+            reports[case_dir] = pages
+            status = f'failed: {error}' if error else f'{len(pages)} pages'
+            print(f'[{i + 1}/{len(pending)}] {os.path.basename(case_dir)}: {status}')
+    return reports
+
+
+def main(case_name, prefix='squid', workdir=None, max_workers=None, force=False):
+    """
+    Bring the summary pages of every finished case in workdir/case_name up to date.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    results_dir = os.path.join(workdir, case_name)
+    case_dirs = [os.path.join(results_dir, case) for case in results_store.list_cases(results_dir, prefix)]
+    return render_reports(case_dirs, prefix, max_workers, force)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='summary_report', description='Render the PROCESS summary pages of a scan')
+    parser.add_argument('results_dir')
+    parser.add_argument('-n', '--prefix', default='squid')
+    parser.add_argument('-j', '--max-workers', type=int, default=None)
+    parser.add_argument('-f', '--force', action='store_true')
+    args = parser.parse_args()
+    main(os.path.basename(os.path.normpath(args.results_dir)), args.prefix,
+         os.path.dirname(os.path.abspath(args.results_dir)), args.max_workers, args.force)
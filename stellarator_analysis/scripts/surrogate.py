@@ -0,0 +1,277 @@
+'''
+Surrogate model of the PROCESS optimum, trained on collected scans
+
+Gaussian process regression (NumPy only) of chosen outputs, e.g. rmajor
+or coe, and of the ineq_con### residuals over one or more input
+variables. The models give a mean and a standard deviation at any input
+point, and the residuals give the probability that each constraint is
+active there (|residual| < active_tol, as in adaptive_scan).
+
+    query = results_query.open_scan('stellarator_analysis/design_space_R_B/HTS_hfact/results')
+    model = surrogate.train(query, outputs=('rmajor', 'coe'))
+    prediction = model.predict([[6.1], [6.4]])
+    prediction.mean['rmajor'], prediction.std['rmajor'], prediction.active_sets()
+    new_values = model.suggest(5)      # the least certain points, to run with PROCESS
+
+The inputs default to the scan value of the cases ('_scan_value'). Inputs
+are scaled to [0, 1] over the training data and outputs standardised; the
+length scales and the nugget of each model are chosen by maximum marginal
+likelihood on a grid. Only converged cases are used.
+'''
+from dataclasses import dataclass
+import numpy as np
+import itertools
+import math
+
+LENGTH_SCALES = np.logspace(-2, 0.5, 26)
+NUGGETS = (1e-8, 1e-6, 1e-4, 1e-2)
+JITTER = 1e-10
+
+_erf = np.vectorize(math.erf, otypes=[float])
+
+
+def normal_cdf(z):
+    return 0.5 * (1 + _erf(np.asarray(z) / math.sqrt(2)))
+
+
+def squared_exponential(x1, x2, length_scales):
+    """
+    Correlation matrix exp(-|x1 - x2|^2 / 2) with every dimension divided by its length scale.
+    """
+    d = (x1[:, None, :] - x2[None, :, :]) / length_scales
+    return np.exp(-0.5 * np.sum(d ** 2, axis=-1))
+
+
+class GaussianProcess:
+    """
+    Gaussian process of one output with a constant mean and a squared
+    exponential kernel. The signal variance is the maximum likelihood
+    estimate for the given length scales and nugget.
+    """
+
+    def __init__(self, length_scales, nugget):
+        self.length_scales = np.asarray(length_scales, dtype=float)
+        self.nugget = nugget
+
+    def fit(self, x, y):
+        self.x = x
+        self.offset = float(np.mean(y))
+        self.scale = float(np.std(y)) or 1.0
+        z = (y - self.offset) / self.scale
+        n = len(z)
+        correlation = squared_exponential(x, x, self.length_scales) + (self.nugget + JITTER) * np.eye(n)
+        self.cholesky = np.linalg.cholesky(correlation)
+        self.alpha = np.linalg.solve(self.cholesky.T, np.linalg.solve(self.cholesky, z))
+        self.signal_variance = max(float(z @ self.alpha) / n, 1e-12)
+        self.log_likelihood = -0.5 * n * math.log(self.signal_variance) - float(np.sum(np.log(np.diag(self.cholesky))))
+        return self
+
+    def predict(self, x):
+        """
+        Mean and standard deviation of the output at the points x.
+        """
+        k = squared_exponential(x, self.x, self.length_scales)
+        mean = k @ self.alpha
+        v = np.linalg.solve(self.cholesky, k.T)
+        variance = self.signal_variance * np.clip(1 - np.sum(v ** 2, axis=0), 0, None)
+        return self.offset + self.scale * mean, self.scale * np.sqrt(variance)
+
+    def loo_residuals(self):
+        """
+        Leave-one-out prediction errors at the training points, in output units.
+        """
+        inverse = np.linalg.solve(self.cholesky.T, np.linalg.solve(self.cholesky, np.eye(len(self.x))))
+        return self.scale * self.alpha / np.diag(inverse)
+
+
+def fit_process(x, y):
+    """
+    GaussianProcess of y over x with the length scales (one per dimension
+    for up to two inputs, a common one above) and nugget of the highest
+    marginal likelihood.
+    """
+    if len(y) < 2:
+        raise ValueError(f'At least 2 points are needed to fit a surrogate, got {len(y)}')
+    n_dims = x.shape[1]
+    if n_dims <= 2:
+        candidates = itertools.product(*[LENGTH_SCALES] * n_dims)
+    else:
+        candidates = ([length] * n_dims for length in LENGTH_SCALES)
+    best = None
+    for length_scales in candidates:
+        for nugget in NUGGETS:
+            try:
+                process = GaussianProcess(length_scales, nugget).fit(x, y)
+            except np.linalg.LinAlgError:
+                continue
+            if best is None or process.log_likelihood > best.log_likelihood:
+                best = process
+    if best is None:
+        raise ValueError(f'No surrogate could be fitted to {len(y)} points: the correlation matrix is singular '
+                         f'for every length scale and nugget, e.g. because of repeated inputs')
+    return best
+
+
+@dataclass
+class Prediction:
+    """
+    Surrogate outputs at a set of input points.
+    """
+    points: np.ndarray
+    mean: dict
+    std: dict
+    constraints: list
+    active_probability: np.ndarray
+
+    def active_sets(self, threshold=0.5):
+        """
+        [[constraint ids]] predicted active at every point.
+        """
+        return [[c for c, p in zip(self.constraints, row) if p > threshold] for row in self.active_probability]
+
+
+class Surrogate:
+    """
+    Gaussian processes of outputs and constraint residuals over inputs.
+    """
+
+    def __init__(self, inputs=('_scan_value',), outputs=(), constraints=(), active_tol=1e-3):
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.constraints = list(constraints)
+        self.active_tol = active_tol
+        self.models = {}
+
+    def scale(self, points):
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        return (points - self.lower) / self.span
+
+    def fit(self, arrays):
+        """
+        Fit one model per output and constraint from {name: array} of
+        converged cases, e.g. results_query.Query.arrays().
+        """
+        points = np.column_stack([np.asarray(arrays[name], dtype=float) for name in self.inputs])
+        usable = np.all(np.isfinite(points), axis=1)
+        targets = self.outputs + [f'ineq_con{c}' for c in self.constraints]
+        if not usable.any():
+            raise ValueError(f'Cannot fit {", ".join(targets)}: no case has finite values of all inputs '
+                             f'{", ".join(self.inputs)}')
+        self.lower = points[usable].min(axis=0)
+        self.span = np.where(np.ptp(points[usable], axis=0) > 0, np.ptp(points[usable], axis=0), 1.0)
+        self.training_points = points[usable]
+        x = self.scale(points)
+        for name in targets:
+            y = np.asarray(arrays[name], dtype=float)
+            finite = usable & np.isfinite(y)
+            if finite.sum() < 2:
+                raise ValueError(f'Cannot fit {name}: it is finite in {int(finite.sum())} of the usable cases, '
+                                 f'at least 2 are needed')
+            self.models[name] = fit_process(x[finite], y[finite])
+        return self
+
+    def predict(self, points):
+        """
+        Prediction of all outputs and constraint activity at the points,
+        an array of shape (n_points, n_inputs) or a list of scan values.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, len(self.inputs))
+        x = self.scale(points)
+        mean, std = {}, {}
+        for name, model in self.models.items():
+            mean[name], std[name] = model.predict(x)
+        active = np.zeros((len(points), len(self.constraints)))
+        for j, c in enumerate(self.constraints):
+            m, s = mean[f'ineq_con{c}'], np.maximum(std[f'ineq_con{c}'], 1e-300)
+            active[:, j] = normal_cdf((self.active_tol - m) / s) - normal_cdf((-self.active_tol - m) / s)
+        return Prediction(points, mean, std, self.constraints, active)
+
+    def grid(self, n=101):
+        """
+        Points of a regular grid over the range of the training data, n per input.
+        """
+        axes = [self.lower[i] + self.span[i] * np.linspace(0, 1, n) for i in range(len(self.inputs))]
+        return np.array(list(itertools.product(*axes)))
+
+    def uncertainty(self, prediction):
+        """
+        Score of every predicted point: the largest relative standard
+        deviation of the outputs plus, for every constraint, how close its
+        active probability is to 1/2 (1 at 1/2, 0 at 0 or 1).
+        """
+        score = np.zeros(len(prediction.points))
+        for name in self.outputs:
+            scale = self.models[name].scale + abs(self.models[name].offset)
+            score = np.maximum(score, prediction.std[name] / scale)
+        if self.constraints:
+            score += np.max(1 - np.abs(2 * prediction.active_probability - 1), axis=1)
+        return score
+
+    def spacing(self):
+        """
+        Median distance (scaled units, largest over the inputs) from every
+        training point to its nearest neighbour.
+        """
+        x = self.scale(self.training_points)
+        if len(x) < 2:
+            return 1.0
+        distance = np.max(np.abs(x[:, None, :] - x[None, :, :]), axis=-1)
+        np.fill_diagonal(distance, np.inf)
+        return float(np.median(distance.min(axis=1)))
+
+    def suggest(self, n_points, candidates=None, min_distance=None):
+        """
+        The n_points candidates (default: grid()) the surrogate is least
+        certain about, at least min_distance (in scaled units, default half
+        the spacing() of the training data) from the training data and from
+        each other. These are the points worth running with PROCESS. Fewer
+        points are returned, with a warning, if not enough candidates are
+        far enough apart.
+        """
+        if candidates is None:
+            candidates = self.grid()
+        if min_distance is None:
+            min_distance = 0.5 * self.spacing()
+        candidates = np.asarray(candidates, dtype=float).reshape(-1, len(self.inputs))
+        score = self.uncertainty(self.predict(candidates))
+        taken = list(self.scale(self.training_points))
+        chosen = []
+        for i in np.argsort(-score, kind='stable'):
+            x = self.scale(candidates[i])[0]
+            if all(np.max(np.abs(x - t)) >= min_distance for t in taken):
+                chosen.append(candidates[i])
+                taken.append(x)
+                if len(chosen) == n_points:
+                    break
+        if len(chosen) < n_points:
+            print(f'Warning: only {len(chosen)} of {n_points} points are at least {min_distance:.3g} '
+                  f'(scaled) from the training data and each other')
+        return np.array(chosen).reshape(-1, len(self.inputs))
+
+    def report(self):
+        """
+        Print the leave-one-out error of every model.
+        """
+        print(f'Surrogate over {", ".join(self.inputs)} from {len(self.training_points)} cases:')
+        for name, model in self.models.items():
+            residuals = model.loo_residuals()
+            rms = float(np.sqrt(np.mean(residuals ** 2)))
+            print(f'  {name:<40} leave-one-out RMS error {rms:.3g} '
+                  f'({rms / (abs(model.offset) + model.scale):.2%} of typical value), '
+                  f'length scales {", ".join(f"{length:.3g}" for length in model.length_scales)}')
+
+
+def train(query, inputs=('_scan_value',), outputs=('rmajor', 'coe'), constraints=None, active_tol=1e-3):
+    """
+    Surrogate fitted to the converged cases of a results_query.Query.
+    constraints are ids such as '024', by default all ineq_con columns.
+    """
+    if constraints is None:
+        names = set()
+        for table in query.tables.values():
+            names.update(name for name in table.names if name.startswith('ineq_con'))
+        constraints = sorted(name[len('ineq_con'):] for name in names)
+    names = [name for name in inputs if not name.startswith('_')] + list(outputs) + \
+        [f'ineq_con{c}' for c in constraints]
+    arrays = query.select(*names).converged().arrays()
+    return Surrogate(inputs, outputs, constraints, active_tol).fit(arrays)
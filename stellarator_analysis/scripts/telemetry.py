@@ -0,0 +1,210 @@
+'''
+Runtime telemetry of the cases of a scan
+
+Every run of a case writes <case>/<prefix>.telemetry.json (run_me.py writes
+the same fields itself, as it runs without this package):
+
+    wall_time     seconds of the run, for run_me.py from the start of the script
+    cpu_time      user + system CPU seconds of the run
+    peak_rss_mb   peak resident memory of the run
+    phases        {phase: seconds} of
+                      import   importing PROCESS (run_me.py only)
+                      input    SingleRun setup: checking and reading IN.DAT
+                      solve    SingleRun.run, except for
+                      output   closing and appending the output files
+    mode          'run_me' or 'worker'
+
+When a case is done, run_cases adds the totals over all its attempts:
+attempts, elapsed, strategy, returncode and converged. The other fields
+are those of the last attempt.
+
+results_store collects the telemetry of every case as telemetry_<field>
+columns next to the MFILE variables (telemetry_phase_<phase> for the
+phases), and report prints the slowest and most iteration-hungry cases.
+'''
+from stellarator_analysis.scripts import results_store
+from contextlib import contextmanager
+import numpy as np
+import argparse
+import resource
+import json
+import time
+import os
+
+COLUMN_PREFIX = 'telemetry_'
+OUTPUT_METHODS = ('finish', 'append_input')
+
+
+def telemetry_path(case_dir, prefix='squid'):
+    return os.path.join(case_dir, prefix + '.telemetry.json')
+
+
+def cpu_time():
+    """
+    User + system CPU seconds of this process.
+    """
+    times = os.times()
+    return times.user + times.system
+
+
+def reset_peak_rss():
+    """
+    Start measuring the peak resident memory of this process anew (Linux
+    only), so a worker reports the peak of each run and not of its lifetime.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB since start or reset_peak_rss.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PhaseTimer:
+    """
+    Sums the wall time spent in named phases.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def wrap(self, obj, method_names, name):
+        """
+        Count the time spent in the methods of obj that exist as phase name.
+        """
+        for method_name in method_names:
+            method = getattr(obj, method_name, None)
+            if callable(method):
+                setattr(obj, method_name, self._timed(method, name))
+
+    def _timed(self, method, name):
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return method(*args, **kwargs)
+        return timed
+
+
+def run_single(single_run_class, indat_path, timer):
+    """
+    Run SingleRun on indat_path, timing its phases with timer.
+    """
+    with timer.phase('input'):
+        single_run = single_run_class(indat_path)
+    timer.wrap(single_run, OUTPUT_METHODS, 'output')
+    with timer.phase('solve'):
+        single_run.run()
+    timer.phases['solve'] -= timer.phases.get('output', 0.0)
+    return single_run
+
+
+def read(case_dir, prefix='squid'):
+    """
+    Telemetry of a case, {} if there is none.
+    """
+    try:
+        with open(telemetry_path(case_dir, prefix)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write(case_dir, prefix, telemetry):
+    path = telemetry_path(case_dir, prefix)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(telemetry, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def update(case_dir, prefix, since=None, **fields):
+    """
+    Add fields to the telemetry of a case. Telemetry written before since
+    (a time.time() value) is from an earlier run and is dropped.
+    """
+    path = telemetry_path(case_dir, prefix)
+    telemetry = read(case_dir, prefix)
+    if telemetry and since is not None and os.stat(path).st_mtime < since:
+        telemetry = {}
+    telemetry.update(fields)
+    write(case_dir, prefix, telemetry)
+    return telemetry
+
+
+def flatten(telemetry):
+    """
+    {column name: value} of a telemetry dict, e.g. telemetry_wall_time and
+    telemetry_phase_solve.
+    """
+    columns = {}
+    for name, value in telemetry.items():
+        if name == 'phases':
+            columns.update({f'{COLUMN_PREFIX}phase_{phase}': float(seconds) for phase, seconds in value.items()})
+        elif isinstance(value, bool):
+            columns[COLUMN_PREFIX + name] = int(value)
+        elif isinstance(value, (int, float, str)):
+            columns[COLUMN_PREFIX + name] = value
+    return columns
+
+
+def report(results_dir, prefix='squid', n=10):
+    """
+    Print the n slowest and the n most iteration-hungry cases of a scan,
+    from its results store.
+    """
+    table = results_store.load(results_dir, prefix)
+    names = ['telemetry_elapsed', 'telemetry_wall_time', 'telemetry_cpu_time', 'telemetry_peak_rss_mb',
+             'telemetry_attempts', 'nviter', 'sqsumsq', 'ifail']
+    columns = {name: table.column(name) if name in table else np.full(len(table), np.nan) for name in names}
+    time_column = np.where(np.isfinite(columns['telemetry_elapsed']), columns['telemetry_elapsed'],
+                           columns['telemetry_wall_time'])
+    if not np.isfinite(time_column).any():
+        print(f'No telemetry in {results_dir}')
+        return
+
+    header = (f'{"case":>24} {"time/s":>9} {"cpu/s":>9} {"rss/MB":>8} {"attempts":>8} {"nviter":>7} '
+              f'{"sqsumsq":>10} {"ifail":>5}')
+
+    def print_rows(title, order):
+        print(title)
+        print(header)
+        for row in order[:n]:
+            print(f'{table.cases[row]:>24} {time_column[row]:9.1f} {columns["telemetry_cpu_time"][row]:9.1f} '
+                  f'{columns["telemetry_peak_rss_mb"][row]:8.0f} {columns["telemetry_attempts"][row]:8.0f} '
+                  f'{columns["nviter"][row]:7.0f} {columns["sqsumsq"][row]:10.2e} {columns["ifail"][row]:5.0f}')
+
+    timed = np.flatnonzero(np.isfinite(time_column))
+    print_rows(f'Slowest cases of {results_dir} ({np.nansum(time_column):.0f} s in total):',
+               timed[np.argsort(-time_column[timed], kind='stable')])
+    iterated = np.flatnonzero(np.isfinite(columns['nviter']))
+    if len(iterated):
+        print_rows('Most solver iterations:', iterated[np.argsort(-columns['nviter'][iterated], kind='stable')])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='telemetry', description='Slowest and most iterated cases of a scan')
+    parser.add_argument('results_dir')
+    parser.add_argument('-n', '--prefix', default='squid')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    report(args.results_dir, args.prefix, args.top)
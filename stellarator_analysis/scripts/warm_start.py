@@ -0,0 +1,89 @@
+'''
+Warm start of scan points from the converged solution of a neighbouring case
+
+The final iteration variables (itvar###) of a converged MFILE are written as
+initial values into the IN.DAT of the next case, clipped to the bounds
+(boundl###/boundu###) the neighbour was solved with.
+'''
+from stellarator_analysis.scripts.mfile_cache import get_mfile
+from stellarator_analysis.scripts.indat_model import InDatModel
+import os
+
+
+def itvar_name(variable):
+    """
+    Name of an iteration variable from the description of its itvar### entry.
+    """
+    return variable.var_description.strip().strip('_').replace(' ', '_')
+
+
+def read_solution(mfile_path):
+    """
+    Return the final iteration variables of a converged MFILE as
+    {name: (value, lower_bound, upper_bound)}, None if it did not converge.
+    """
+    if not os.path.isfile(mfile_path):
+        return None
+    m = get_mfile(mfile_path)
+    if 'ifail' not in m.data or m.data['ifail'].get_scan(-1) != 1:
+        return None
+
+    solution = {}
+    for idx in range(1, int(m.data['nvar'].get_scan(-1)) + 1):
+        itvar = m.data[f'itvar{idx:03d}']
+        solution[itvar_name(itvar)] = (itvar.get_scan(-1),
+                                       m.data[f'boundl{idx:03d}'].get_scan(-1),
+                                       m.data[f'boundu{idx:03d}'].get_scan(-1))
+    return solution
+
+
+def read_start_point(mfile_path):
+    """
+    Return the initial iteration variables a run was started from as
+    {name: (value, lower_bound, upper_bound)}, recovered from itvar###/xcm###.
+    Works for failed runs as well, None if the MFILE does not exist.
+    """
+    if not os.path.isfile(mfile_path):
+        return None
+    m = get_mfile(mfile_path)
+
+    start_point = {}
+    for idx in range(1, int(m.data['nvar'].get_scan(-1)) + 1):
+        itvar = m.data[f'itvar{idx:03d}']
+        ratio = m.data[f'xcm{idx:03d}'].get_scan(-1)
+        value = itvar.get_scan(-1) / ratio if ratio else itvar.get_scan(-1)
+        start_point[itvar_name(itvar)] = (value,
+                                          m.data[f'boundl{idx:03d}'].get_scan(-1),
+                                          m.data[f'boundu{idx:03d}'].get_scan(-1))
+    return start_point
+
+
+def start_values(solution, exclude=()):
+    """
+    Initial values from a solution clipped to its bounds, without the
+    variables listed in exclude (e.g. the scan variable itself).
+    """
+    return {name: min(max(value, lower), upper)
+            for name, (value, lower, upper) in solution.items()
+            if name not in exclude}
+
+
+def warm_start(indat_path, mfile_path, exclude=()):
+    """
+    Seed the iteration variables of indat_path from the converged MFILE at
+    mfile_path. Returns the values written, None if the MFILE is not usable.
+    """
+    solution = read_solution(mfile_path)
+    if solution is None:
+        return None
+
+    values = start_values(solution, exclude)
+    set_parameters(indat_path, values)
+    return values
+
+
+def set_parameters(indat_path, values):
+    """
+    Set {name: value} parameters in an IN.DAT file in place.
+    """
+    InDatModel.from_file(indat_path).apply(values).write(indat_path)